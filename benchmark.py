@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Benchmarks for the difftools plugin
+
+This script generates a synthetic bzr branch, then times each phase of a
+'bzr diff --using' run against it, and prints the results as JSON:
+
+   python benchmark.py --files 2000 --size 4096 --depth 3 --changed 5
+
+The phases timed are loading the plugin (in a fresh interpreter, which
+is all the plugin adds to other commands such as 'bzr status'), the
+dirstate check in Controller.run, and the ones in compare_using: opening
+the tree, get_tree_files, opening the basis tree, get_diffs_or_stop,
+extraction to a NamedTemporaryDir (whole tree, sparse, and individual
+files, with the read-only bit set as part of each), the tool launch and
+the cleanup.  A stub diff tool (the Python interpreter, told to do
+nothing) stands in for the GUI tools, so only the plugin's own overhead
+is measured.  The whole compare_using call is also timed, end to end.
+
+With --http, a second branch (with the changes committed) is served
+over HTTP from this process, using bzrlib's test server, and a comparison
+of its last two revisions is timed too, to measure the remote mode.
+
+Run it from the plugin directory, with bzrlib on the Python path.  The
+text cache is disabled unless --cache is given, so that every run does
+the same work.
+"""
+
+import imp
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import bzrlib
+from bzrlib import (
+    bzrdir,
+    osutils,
+    revisionspec,
+    workingtree,
+    )
+
+import textcache
+from controller import (compare_using, get_tree_files, get_diffs_or_stop,
+                        unchanged_in_working_tree)
+from difftool import TreeDiffTool, ListDiffTool
+from tempdir import NamedTemporaryDir
+
+
+class Timer(object):
+  """
+  Collect the wall-clock times for each named phase, over several runs.
+  """
+
+  def __init__(self):
+    """
+    Start with no timings.
+    """
+    self.phases = []
+    self.times = {}
+    return
+
+  def time(self, name, func, *args, **kwargs):
+    """
+    Call a function, record how long it took, and return its result.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    self.add(name, time.time() - start)
+    return result
+
+  def add(self, name, elapsed):
+    """
+    Record a time measured elsewhere (e.g. in another process).
+    """
+    if name not in self.times:
+      self.phases.append(name)
+      self.times[name] = []
+    self.times[name].append(elapsed)
+    return
+
+  def summary(self):
+    """
+    Return a dictionary of {phase: {min, mean, max, runs}} for all phases.
+    """
+    result = {}
+    for name in self.phases:
+      runs = self.times[name]
+      result[name] = {
+          'min': min(runs),
+          'mean': sum(runs) / len(runs),
+          'max': max(runs),
+          'runs': runs,
+          }
+    return result
+
+  # End class Timer
+
+
+# Functions:
+
+def make_branch(path, num_files, file_size, depth, percent_changed, seed=0):
+  """
+  Create a standalone branch with a working tree, and modify some files.
+
+  The files are spread over a directory tree 'depth' levels deep, each
+  holding about file_size bytes of text, and percent_changed of them
+  (but at least one) are modified, a few lines each, after the initial
+  commit.  Return the working tree.
+  """
+  rand = random.Random(seed)
+  tree = bzrdir.BzrDir.create_standalone_workingtree(path)
+  rel_paths = []
+  for i in range(num_files):
+    parts = ['d%d' % ((i >> (4 * level)) % 16) for level in range(depth)]
+    rel_path = osutils.pathjoin(*(parts + ['f%d.txt' % i]))
+    abs_path = osutils.pathjoin(path, rel_path)
+    if not osutils.isdir(osutils.dirname(abs_path)):
+      os.makedirs(osutils.dirname(abs_path))
+    f = open(abs_path, 'wb')
+    f.write(make_text(rand, file_size))
+    f.close()
+    rel_paths.append(rel_path)
+
+  tree.smart_add([path])
+  tree.commit('Synthetic benchmark branch')
+
+  num_changed = max(1, num_files * percent_changed / 100)
+  for rel_path in rand.sample(rel_paths, num_changed):
+    abs_path = osutils.pathjoin(path, rel_path)
+    lines = open(abs_path, 'rb').readlines()
+    for j in range(min(3, len(lines))):
+      lines[rand.randrange(len(lines))] = 'changed %d\n' % rand.random()
+    f = open(abs_path, 'wb')
+    f.writelines(lines)
+    f.close()
+
+  return tree
+
+
+def make_text(rand, size):
+  """
+  Make about 'size' bytes of random text, in lines.
+  """
+  lines = []
+  length = 0
+  while length < size:
+    line = '%x %x %x\n' % (rand.getrandbits(64), rand.getrandbits(64),
+                           rand.getrandbits(32))
+    lines.append(line)
+    length += len(line)
+  return ''.join(lines)
+
+
+def make_stub_tool(kind):
+  """
+  Make a diff tool that starts a process, but does nothing.
+  """
+  if kind == 'list':
+    tool = ListDiffTool('stub', interactive=False)
+  else:
+    tool = TreeDiffTool('stub')
+  tool.path = sys.executable
+  tool.add_options('-c pass')
+  return tool
+
+
+def run_phases(timer, path):
+  """
+  Time each phase of a comparison against the basis tree, in turn.
+  """
+  timer.time('open_tree', workingtree.WorkingTree.open_containing, path)
+  timer.time('quick_check', unchanged_in_working_tree, [path])
+  (b1, work_tree, file_ids, remainder) = timer.time('get_tree_files',
+      get_tree_files, [path], keep_lock=True)
+  try:
+    old_tree = timer.time('basis_tree', b1.basis_tree)
+    changes = timer.time('get_diffs_or_stop', get_diffs_or_stop,
+                         old_tree, work_tree, file_ids)
+    changed_ids = [file_id for file_id in changes.file_ids()
+        if old_tree.has_id(file_id) and
+           old_tree.inventory[file_id].kind == 'file']
+
+    tmp_dirs = []
+    for (name, use_tree, ids, sparse) in [
+        ('extract_tree', True, file_ids, None),
+        ('extract_sparse', True, file_ids, changes),
+        ('extract_files', False, changed_ids, None)]:
+      tmp_dir = NamedTemporaryDir('bzr_diff-', '-bench')
+      timer.time(name, tmp_dir.write_stuff, old_tree, ids, use_tree, sparse)
+      tmp_dirs.append(tmp_dir)
+  finally:
+    work_tree.unlock()
+
+  timer.time('launch_tree_tool', make_stub_tool('tree').run,
+             tmp_dirs[0].path, path)
+  if changed_ids:
+    path_list = [old_tree.id2path(file_id) for file_id in changed_ids]
+    timer.time('launch_list_tool', make_stub_tool('list').run,
+               tmp_dirs[0].path, path, path_list)
+
+  for (name, tmp_dir) in zip(['cleanup_tree', 'cleanup_sparse',
+                              'cleanup_files'], tmp_dirs):
+    timer.time(name, tmp_dir.cleanup)
+
+  timer.time('compare_using', compare_using, make_stub_tool('tree'), [path])
+  return
+
+
+def run_remote_phases(timer, url):
+  """
+  Time a comparison of the last two revisions of a remote branch.
+  """
+  timer.time('compare_remote', compare_using, make_stub_tool('tree'), [url],
+             revisionspec.RevisionSpec.from_string('-2'),
+             revisionspec.RevisionSpec.from_string('-1'))
+  return
+
+
+def serve_http(path):
+  """
+  Serve a directory over HTTP (with range requests), return the server.
+  """
+  from bzrlib.tests import http_server
+  # The server serves the current directory:
+  old_cwd = os.getcwd()
+  os.chdir(path)
+  try:
+    server = http_server.HttpServer()
+    if hasattr(server, 'start_server'):
+      server.start_server()
+    else:
+      server.setUp()
+  finally:
+    os.chdir(old_cwd)
+  return server
+
+
+def stop_http(server):
+  """
+  Stop a server started by serve_http.
+  """
+  if hasattr(server, 'stop_server'):
+    server.stop_server()
+  else:
+    server.tearDown()
+  return
+
+
+# Loads the plugin in a fresh interpreter, as 'bzr' does at startup:
+IMPORT_SCRIPT = """
+import imp, sys, time
+import bzrlib.commands
+start = time.time()
+imp.load_source('bzr_difftools_import', sys.argv[1])
+print time.time() - start, 'bzrlib.builtins' in sys.modules
+"""
+
+
+def time_plugin_import(timer):
+  """
+  Time loading the plugin, return True if it imported bzrlib.builtins.
+
+  This is the cost that the plugin adds to every bzr command (e.g. 'bzr
+  status'), not just to 'bzr diff'.
+  """
+  proc = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT,
+                           plugin_file('__init__.py')],
+                          stdout=subprocess.PIPE)
+  (elapsed, builtins_imported) = proc.communicate()[0].split()
+  timer.add('plugin_import', float(elapsed))
+  return builtins_imported == 'True'
+
+
+def plugin_file(name):
+  """
+  Return the path of a file in the plugin directory.
+  """
+  return osutils.pathjoin(osutils.dirname(osutils.abspath(__file__)), name)
+
+
+def plugin_version():
+  """
+  Return the version_info of the plugin in this directory.
+  """
+  plugin = imp.load_source('bzr_difftools_benchmark',
+                           plugin_file('__init__.py'))
+  return plugin.version_info
+
+
+def main(argv):
+  """
+  Parse the options, build the branch, and run the benchmarks.
+  """
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--files', type='int', default=1000,
+                    help='number of files in the branch')
+  parser.add_option('--size', type='int', default=4096,
+                    help='approximate size of each file, in bytes')
+  parser.add_option('--depth', type='int', default=2,
+                    help='depth of the directory tree')
+  parser.add_option('--changed', type='int', default=5,
+                    help='percentage of files to modify')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='number of times to run each phase')
+  parser.add_option('--cache', action='store_true', default=False,
+                    help='leave the text cache enabled')
+  parser.add_option('--http', action='store_true', default=False,
+                    help='also time a branch served over HTTP')
+  parser.add_option('--keep', action='store_true', default=False,
+                    help='keep the generated branch')
+  parser.add_option('--output', default=None,
+                    help='write the JSON results to a file')
+  (options, args) = parser.parse_args(argv)
+  # Without any changes, there would be nothing to extract or compare:
+  if not 1 <= options.changed <= 100:
+    parser.error('--changed must be between 1 and 100')
+  if options.files < 1:
+    parser.error('--files must be at least 1')
+
+  if not options.cache:
+    textcache._text_cache = False
+
+  base_dir = tempfile.mkdtemp(prefix='bzr_difftools_bench-')
+  try:
+    branch_path = osutils.pathjoin(base_dir, 'branch')
+    timer = Timer()
+    imports_builtins = None
+    for i in range(options.repeat):
+      imports_builtins = time_plugin_import(timer)
+    timer.time('make_branch', make_branch, branch_path, options.files,
+               options.size, options.depth, options.changed)
+    for i in range(options.repeat):
+      run_phases(timer, branch_path)
+
+    if options.http:
+      remote_tree = timer.time('make_remote_branch', make_branch,
+          osutils.pathjoin(base_dir, 'remote'), options.files,
+          options.size, options.depth, options.changed)
+      remote_tree.commit('Synthetic benchmark changes')
+      server = serve_http(base_dir)
+      try:
+        for i in range(options.repeat):
+          run_remote_phases(timer, server.get_url() + 'remote')
+      finally:
+        stop_http(server)
+  finally:
+    if not options.keep:
+      shutil.rmtree(base_dir, ignore_errors=True)
+
+  results = {
+      'plugin_version': plugin_version(),
+      'bzrlib_version': bzrlib.version_info,
+      'python_version': sys.version.split()[0],
+      'plugin_imports_builtins': imports_builtins,
+      'parameters': {
+          'files': options.files,
+          'size': options.size,
+          'depth': options.depth,
+          'changed': options.changed,
+          'repeat': options.repeat,
+          'cache': options.cache,
+          'http': options.http,
+          },
+      'phases': timer.summary(),
+      }
+  if options.output:
+    out = open(options.output, 'w')
+  else:
+    out = sys.stdout
+  json.dump(results, out, indent=2, sort_keys=True)
+  out.write('\n')
+  return 0
+
+
+if __name__ == '__main__':
+  if hasattr(bzrlib, 'initialize'):
+    library_state = bzrlib.initialize()
+    library_state.__enter__()
+  sys.exit(main(sys.argv[1:]))
+
+# The End.
@@ -0,0 +1,186 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Index of the changed paths in a comparison
+
+A TreeDelta records each kind of change (added, removed, renamed, modified,
+kind changed) in its own list, with its own tuple layout.  The ChangeIndex
+flattens these into one list of ChangedPath entries, each with the old
+path, new path, kind and type of change, so the extraction and launch
+stages can both use it without rescanning the delta.
+
+All paths are relative to the root of their tree, with '/' separators,
+as in the inventory.  The old path of an added entry, and the new path
+of a removed entry, are None.
+"""
+
+import copy
+
+
+class ChangedPath(object):
+  """
+  A single changed entry in a comparison.
+  """
+
+  def __init__(self, file_id, kind, change, old_path, new_path,
+               text_modified=True):
+    """
+    Record the details of one changed entry.
+    """
+    self.file_id = file_id
+    self.kind = kind
+    self.change = change
+    self.old_path = old_path
+    self.new_path = new_path
+    self.text_modified = text_modified
+    return
+
+  def __repr__(self):
+    return '%s(%r, %r, %r, %r)' % (self.__class__.__name__, self.change,
+                                   self.file_id, self.old_path, self.new_path)
+
+  # End class ChangedPath
+
+
+class ChangeIndex(object):
+  """
+  The changed paths of a comparison, built once from a TreeDelta.
+  """
+
+  def __init__(self, delta):
+    """
+    Index every entry in a TreeDelta, ordered by path.
+    """
+    entries = []
+    for (path, file_id, kind) in delta.added:
+      entries.append(ChangedPath(file_id, kind, 'added', None, path))
+    for (path, file_id, kind) in delta.removed:
+      entries.append(ChangedPath(file_id, kind, 'removed', path, None))
+    for (old_path, new_path, file_id, kind, text_modified,
+         meta_modified) in delta.renamed:
+      entries.append(ChangedPath(file_id, kind, 'renamed', old_path,
+                                 new_path, text_modified))
+    for (path, file_id, kind, text_modified,
+         meta_modified) in delta.modified:
+      entries.append(ChangedPath(file_id, kind, 'modified', path, path,
+                                 text_modified))
+    for (path, file_id, old_kind, new_kind) in getattr(delta,
+                                                      'kind_changed', []):
+      entries.append(ChangedPath(file_id, new_kind, 'kind changed', path,
+                                 path))
+
+    decorated = [(entry.new_path or entry.old_path, entry)
+        for entry in entries]
+    decorated.sort()
+    self.entries = [entry for (path, entry) in decorated]
+    self.skipped = []
+    return
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __iter__(self):
+    return iter(self.entries)
+
+  def file_ids(self):
+    """
+    Return the file_ids of every changed entry.
+    """
+    return [entry.file_id for entry in self.entries]
+
+  def text_changes(self):
+    """
+    Return the entries for files whose text differs between the trees.
+
+    This includes added and removed files (compared against nothing),
+    but not renames or other changes that leave the text alone.
+    """
+    return [entry for entry in self.entries
+        if entry.kind == 'file' and entry.text_modified]
+
+  def select(self, file_ids):
+    """
+    Return a copy of this index, with only the entries for these file_ids.
+    """
+    wanted = dict.fromkeys(file_ids)
+    index = copy.copy(self)
+    index.entries = [entry for entry in self.entries
+        if entry.file_id in wanted]
+    return index
+
+  def without(self, file_ids):
+    """
+    Return a copy of this index, without the entries for these file_ids.
+    """
+    unwanted = dict.fromkeys(file_ids)
+    index = copy.copy(self)
+    index.entries = [entry for entry in self.entries
+        if entry.file_id not in unwanted]
+    return index
+
+  def skip(self, file_ids):
+    """
+    Return a copy of this index, with these file_ids left out as skipped.
+
+    Skipped file_ids are listed in the 'skipped' attribute, so they can
+    be left out of an extraction too.
+    """
+    index = self.without(file_ids)
+    index.skipped = self.skipped + list(file_ids)
+    return index
+
+  def union(self, other):
+    """
+    Return a new index, with the entries of this index and another one.
+
+    The same file_id may appear in both (e.g. modified on both sides of
+    a three-way comparison), so it may have more than one entry.
+    """
+    decorated = [(entry.new_path or entry.old_path, entry)
+        for entry in self.entries + other.entries]
+    decorated.sort()
+    index = copy.copy(self)
+    index.entries = [entry for (path, entry) in decorated]
+    index.skipped = self.skipped + other.skipped
+    return index
+
+  def pairs(self, old_prefix='', new_prefix=''):
+    """
+    Return (old, new) paths for each text change, relative to a prefix.
+
+    The prefixes are the tree paths of the directories being compared,
+    on each side.  Entries outside a prefix (e.g. renamed out of the
+    directory) get a path starting with '..', so joining it to the
+    directory still gives the right file.  For an added or removed file,
+    the missing side uses the same path as the other side.
+    """
+    pairs = []
+    for entry in self.text_changes():
+      old_path = entry.old_path or entry.new_path
+      new_path = entry.new_path or entry.old_path
+      pairs.append((relative_path(old_prefix, old_path),
+                    relative_path(new_prefix, new_path)))
+
+    return pairs
+
+  # End class ChangeIndex
+
+
+# Functions:
+
+def relative_path(prefix, path):
+  """
+  Return a tree path relative to a directory, also in the tree.
+  """
+  if not prefix:
+    return path
+  if path == prefix:
+    return '.'
+  if path.startswith(prefix + '/'):
+    return path[len(prefix) + 1:]
+
+  return '../' * (prefix.count('/') + 1) + path
+
+# The End.
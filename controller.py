@@ -15,18 +15,141 @@ from bzrlib import (
     errors,
     osutils,
     transport,
+    urlutils,
     workingtree,
     )
 
 from difftool import (register_diff_tool, find_diff_tool, 
-                      TreeDiffTool, ListDiffTool)
+                      TreeDiffTool, ListDiffTool, VimBatchDiffTool,
+                      ServerDiffTool, VimServerDiffTool, EmacsDiffTool)
+from changes import ChangeIndex
+from internaldiff import (InternalDiffTool, SideBySideDiffTool, HtmlDiffTool,
+                          JsonReportTool)
+from routing import Router
 from tempdir import NamedTemporaryDir
+import timings
+import window
+
+
+TMP_PREFIX = 'bzr_diff-'
 
 
 class NoDifferencesFound(Exception):
   pass
 
 
+class TreeSession(object):
+  """
+  The trees used for one comparison, held under a single lock scope.
+
+  Trees are opened (and read-locked) once, and stay locked until close()
+  is called, so the whole extraction phase runs under one lock.  The
+  resolution of revision specs, and inventory lookups, are memoized, as
+  each of these can be expensive (e.g. walking the revision history).
+
+  Remote branches are all opened through the same list of transports, so
+  a connection (e.g. to an sftp server) is made once and then reused.
+  """
+
+  def __init__(self):
+    """
+    Start a new session, with no trees open.
+    """
+    self.locked_trees = []
+    self.transports = []
+    self.revision_infos = {}
+    self.revision_trees = {}
+    self.inventory_info = {}
+    return
+
+  def open(self, file_list):
+    """
+    Open and lock the tree for the first file(s) in file_list.
+
+    See get_tree_files for the values returned.
+    """
+    result = get_tree_files(file_list, keep_lock=True,
+                            possible_transports=self.transports)
+    self.locked_trees.append(result[1])
+    return result
+
+  def revision_info(self, branch, spec):
+    """
+    Resolve a revision spec in the history of a branch (memoized).
+    """
+    key = (branch.base, spec.__class__, spec.spec)
+    if key not in self.revision_infos:
+      self.revision_infos[key] = spec.in_history(branch)
+    return self.revision_infos[key]
+
+  def revision_tree(self, branch, spec):
+    """
+    Return the revision tree for a revision spec (memoized).
+    """
+    return self.revision_id_tree(branch,
+                                 self.revision_info(branch, spec).rev_id)
+
+  def revision_id_tree(self, branch, rev_id):
+    """
+    Return the revision tree for a revision id (memoized).
+    """
+    if rev_id not in self.revision_trees:
+      self.revision_trees[rev_id] = branch.repository.revision_tree(rev_id)
+    return self.revision_trees[rev_id]
+
+  def merge_base(self, branch, spec1, spec2):
+    """
+    Return the revision id of the merge base of two revision specs.
+    """
+    rev_id1 = self.revision_info(branch, spec1).rev_id
+    rev_id2 = self.revision_info(branch, spec2).rev_id
+    graph = branch.repository.get_graph()
+    return graph.find_unique_lca(rev_id1, rev_id2)
+
+  def kind(self, tree, file_id):
+    """
+    Return the kind of an inventory entry (memoized).
+    """
+    return self._inventory_lookup('kind', tree, file_id,
+                                  tree.inventory.get_file_kind)
+
+  def id2path(self, tree, file_id):
+    """
+    Return the path of an inventory entry (memoized).
+    """
+    return self._inventory_lookup('path', tree, file_id,
+                                  tree.inventory.id2path)
+
+  def tree_path(self, tree, file_id, default=None):
+    """
+    Return the path of an entry in a tree, or default if it is not there.
+    """
+    if tree.has_id(file_id):
+      return self.id2path(tree, file_id)
+    return default
+
+  def close(self):
+    """
+    Release the locks on all trees opened in this session.
+    """
+    release_read_locks(self.locked_trees)
+    self.locked_trees = []
+    return
+
+  # Private Methods:
+
+  def _inventory_lookup(self, what, tree, file_id, lookup):
+    """
+    Memoize one kind of inventory lookup.
+    """
+    key = (what, id(tree), file_id)
+    if key not in self.inventory_info:
+      self.inventory_info[key] = lookup(file_id)
+    return self.inventory_info[key]
+
+  # End class TreeSession
+
+
 class Controller:
   """
   Control how the diff tool is run (using what inputs, which tool, etc.).
@@ -38,27 +161,47 @@ class Controller:
     Run the external diff tool.
     """
 
-    # Get an instance of this tool:
-    assert using is not None
-    tool = find_diff_tool(using)
-    tool.add_options(diff_options)
-    
-    # Default to current working directory:
-    if (not file_list or len(file_list) == 0):
-      file_list = [ osutils.getcwd() ]
-
-    # Pick the right comparison to perform:
-    if revision:
-      if (len(revision) == 1) or (revision[1].spec is None):
-        result = compare_using(tool, file_list, revision[0])
-      elif len(revision) == 2:
-        result = compare_using(tool, file_list, revision[0], revision[1])
+    timings.configure()
+    total_timer = timings.start('total')
+    try:
+
+      # Get an instance of this tool:
+      assert using is not None
+      timer = timings.start('find_tool')
+      try:
+        tool = find_diff_tool(using)
+        tool.add_options(diff_options)
+      finally:
+        timings.stop(timer)
+      
+      # Default to current working directory:
+      if (not file_list or len(file_list) == 0):
+        file_list = [ osutils.getcwd() ]
+
+      # Pick the right comparison to perform:
+      if revision:
+        if len(revision) == 3:
+          # Three-way, with the merge base if the first spec is empty:
+          result = compare_three_using(tool, file_list, revision[0],
+                                       revision[1], revision[2])
+        elif (len(revision) == 1) or (revision[1].spec is None):
+          result = compare_using(tool, file_list, revision[0])
+        elif len(revision) == 2:
+          result = compare_using(tool, file_list, revision[0], revision[1])
+        else:
+          raise errors.BzrCommandError(
+              '--revision takes one, two or three revision specifiers')
       else:
-        raise errors.BzrCommandError(
-            '--revision takes exactly one or two revision specifiers')
-    else:
-      # Just diff against the current base tree:
-      result = compare_using(tool, file_list)
+        # Just diff against the current base tree, if anything changed:
+        if timings.timed('quick_check', unchanged_in_working_tree,
+                         file_list):
+          result = 0
+        else:
+          result = compare_using(tool, file_list)
+
+    finally:
+      timings.stop(total_timer)
+      timings.report()
 
     return result
 
@@ -75,153 +218,404 @@ def compare_using(tool, file_list=None, rev1=None, rev2=None):
   necessary, and run the comparison.  Handle repository branches and
   non-local branches (see get_tree_files).
   """
-  tmp_prefix = 'bzr_diff-'
-
-  # Find the tree(s) and the files associated with each:
-  (b1, work_tree1, file_ids1, remainder) = get_tree_files(file_list)
-  trees_to_lock = [work_tree1]
-  if (len(remainder) > 0):
-    (b2, work_tree2, file_ids2, remainder) = get_tree_files(remainder)
-    b2_in_working_tree = isinstance(work_tree2, workingtree.WorkingTree)
-    trees_to_lock.append(work_tree2)
-    if (len(remainder) > 0):
-      raise errors.BzrCommandError("Cannot compare more than two branches")
-    if rev1 or rev2:
-      raise errors.BzrCommandError("Cannot specify -r with multiple branches")
-  else:
-    b2 = None
-    b2_in_working_tree = False
-
-  get_read_locks(trees_to_lock)
+  session = TreeSession()
+  tmp_dirs = []
   try:
-
-    kind = work_tree1.inventory.get_file_kind(file_ids1[0])
-    in_subdir = (kind == 'directory' or kind == 'root_directory')
-    in_working_tree = isinstance(work_tree1, workingtree.WorkingTree)
-      
-    # Decide which mode (tree or files) to use when writing to tmpdir:
-    if (len(file_list) == 1 and not in_subdir):
-      use_tree = False
-    elif (b2 and not in_subdir):
-      use_tree = False
-    else:
-      use_tree = True
-  
-    # Check if we need to adjust our tmpdir paths:
-    if (len(file_list) == 1) or b2:
-      if in_subdir:
-        adjust_path = work_tree1.inventory.id2path(file_ids1[0])
-      else:
-        adjust_path = osutils.basename(file_list[0])
-    else:
-      adjust_path = ''
+    try:
+      try:
+        # Find the tree(s) and the files associated with each:
+        timer = timings.start('open_trees')
+        try:
+          (b1, work_tree1, file_ids1, remainder) = session.open(file_list)
+          if (len(remainder) > 0):
+            (b2, work_tree2, file_ids2, remainder) = session.open(remainder)
+            b2_in_working_tree = isinstance(work_tree2,
+                                            workingtree.WorkingTree)
+            if (len(remainder) > 0):
+              raise errors.BzrCommandError(
+                  "Cannot compare more than two branches")
+            if rev1 or rev2:
+              raise errors.BzrCommandError(
+                  "Cannot specify -r with multiple branches")
+          else:
+            b2 = None
+            b2_in_working_tree = False
+        finally:
+          timings.stop(timer)
+
+        dir_kinds = ('directory', 'root_directory')
+        in_subdir = (session.kind(work_tree1, file_ids1[0]) in dir_kinds)
+        any_dirs = [file_id for file_id in file_ids1
+            if session.kind(work_tree1, file_id) in dir_kinds]
+        in_working_tree = isinstance(work_tree1, workingtree.WorkingTree)
+        
+        # Decide which mode (tree or files) to use when writing to tmpdir.
+        # Files keep their tree paths, so an explicit selection of several
+        # files can use file mode too, unless a recursive tool will want to
+        # see the whole tree:
+        if (len(file_list) == 1 and not in_subdir):
+          use_tree = False
+        elif (b2 and not in_subdir):
+          use_tree = False
+        elif (not any_dirs and not tool.supports('recursive')):
+          use_tree = False
+        else:
+          use_tree = True
+
+        # Files can be routed to other tools (or skipped), unless the tool
+        # is given whole directories:
+        router = None
+        single_file = (len(file_list) == 1 and not in_subdir)
+        if single_file or not tool.supports('recursive'):
+          router = Router.from_config(tool.command)
+    
+        # Check if we need to adjust our tmpdir paths:
+        if (len(file_list) == 1) or b2:
+          adjust_path = session.id2path(work_tree1, file_ids1[0])
+        else:
+          adjust_path = ''
+    
+        # Files that match a working tree can be cloned instead of extracted:
+        link_sources = [tree for tree in session.locked_trees
+            if isinstance(tree, workingtree.WorkingTree)]
+
+        # Use the 1st revision as the old version (basis_tree is the default):
+        timer = timings.start('resolve_revisions')
+        try:
+          if rev1:
+            old_tree = session.revision_tree(b1, rev1)
+            old_hint = "-rev%s" % session.revision_info(b1, rev1).revno
+          elif b2:
+            old_tree = work_tree1
+            old_hint = '-' + b1.nick
+          else:
+            old_tree = b1.basis_tree()
+            old_hint = "-basis"
+        finally:
+          timings.stop(timer)
+
+        # In-process tools read the texts straight from the trees:
+        if tool.supports('internal'):
+          if rev2:
+            (new_tree, new_ids) = (session.revision_tree(b1, rev2), file_ids1)
+          elif b2:
+            (new_tree, new_ids) = (work_tree2, file_ids2)
+          elif not in_working_tree:
+            (new_tree, new_ids) = (b1.basis_tree(), file_ids1)
+          else:
+            (new_tree, new_ids) = (work_tree1, file_ids1)
+          changes = get_diffs_or_stop(old_tree, new_tree, new_ids)
+          return timings.timed('tool', tool.compare, old_tree, new_tree,
+                               changes)
+
+        # The file or directory may have been renamed, so find it in each
+        # tree:
+        old_adjust_path = adjust_path
+        new_adjust_path = adjust_path
+        if adjust_path:
+          old_adjust_path = session.tree_path(old_tree, file_ids1[0],
+                                              adjust_path)
+
+        # Use the 2nd revision as the new version (the working tree is the
+        # default):
+        new_tmp_dir = None
+        old_tmp_dir = None
+        new_extracted = False
+        if rev2:
+          new_tree = session.revision_tree(b1, rev2)
+          changes = get_diffs_or_stop(old_tree, new_tree, file_ids1, router)
+          new_hint = "-rev%s" % session.revision_info(b1, rev2).revno
+          new_tmp_dir = timings.timed('extract_new', write_tmp_dir, tool,
+              new_tree, file_ids1, new_hint, changes, use_tree, True,
+              link_sources)
+          tmp_dirs.append(new_tmp_dir)
+          if adjust_path:
+            new_adjust_path = session.tree_path(new_tree, file_ids1[0],
+                                                adjust_path)
+          new_root = new_tmp_dir.path
+          new_path = osutils.pathjoin(new_root, new_adjust_path)
+          new_extracted = True
+        elif b2_in_working_tree:
+          # Files from two different branches, branch2 has a working tree:
+          changes = get_diffs_or_stop(old_tree, work_tree2, file_ids2, router)
+          if adjust_path:
+            new_adjust_path = session.tree_path(work_tree2, file_ids2[0],
+                                                adjust_path)
+          new_root = work_tree2.abspath('')
+          new_path = osutils.pathjoin(new_root, new_adjust_path)
+        elif b2:
+          # Files from two different branches, branch2 has no working tree:
+          changes = get_diffs_or_stop(old_tree, work_tree2, file_ids2, router)
+          new_hint = '-' + b2.nick
+          new_tmp_dir = timings.timed('extract_new', write_tmp_dir, tool,
+              work_tree2, file_ids2, new_hint, changes, use_tree, True,
+              link_sources)
+          tmp_dirs.append(new_tmp_dir)
+          if adjust_path:
+            new_adjust_path = session.tree_path(work_tree2, file_ids2[0],
+                                                adjust_path)
+          new_root = new_tmp_dir.path
+          new_path = osutils.pathjoin(new_root, new_adjust_path)
+          new_extracted = True
+        elif not in_working_tree:
+          # Repository branch or remote branch, but only one revision:
+          new_tree = b1.basis_tree()
+          changes = get_diffs_or_stop(old_tree, new_tree, file_ids1, router)
+          new_hint = "-basis"
+          new_tmp_dir = timings.timed('extract_new', write_tmp_dir, tool,
+              new_tree, file_ids1, new_hint, changes, use_tree, True,
+              link_sources)
+          tmp_dirs.append(new_tmp_dir)
+          if adjust_path:
+            new_adjust_path = session.tree_path(new_tree, file_ids1[0],
+                                                adjust_path)
+          new_root = new_tmp_dir.path
+          new_path = osutils.pathjoin(new_root, new_adjust_path)
+          new_extracted = True
+        else:
+          # Item(s) in working tree, just diff it in place:
+          changes = get_diffs_or_stop(old_tree, work_tree1, file_ids1, router)
+          if adjust_path:
+            new_adjust_path = session.tree_path(work_tree1, file_ids1[0],
+                                                adjust_path)
+          new_root = work_tree1.abspath('')
+          new_path = osutils.pathjoin(new_root, new_adjust_path)
   
-    cleanup = tool.supports('cleanup')
+        # No exceptions yet, so we really do need to extract the old version:
+        if b2 and in_working_tree:
+          old_root = work_tree1.abspath('')
+          old_path = osutils.pathjoin(old_root, old_adjust_path)
+        else:
+          if new_extracted:
+            old_sources = [new_tmp_dir] + link_sources
+          else:
+            old_sources = link_sources
+          old_tmp_dir = timings.timed('extract_old', write_tmp_dir, tool,
+              old_tree, file_ids1, old_hint, changes, use_tree,
+              new_extracted, old_sources)
+          tmp_dirs.append(old_tmp_dir)
+          old_root = old_tmp_dir.path
+          old_path = osutils.pathjoin(old_root, old_adjust_path)
+    
+      finally:
+        # Release the locks before we start any interactive tools:
+        session.close()
+
+      # Run the comparison, and any files routed to other tools:
+      routed = {}
+      if router:
+        routed = router.routed
+      if single_file:
+        # A single file goes to the one tool it was routed to, if any, or
+        # else shows only the changed regions if it is very large:
+        if routed:
+          (tool_name,) = routed.keys()
+          file_tool = find_diff_tool(tool_name)
+        else:
+          file_tool = tool
+          (old_path, new_path, window_dirs) = window_large_files(tool,
+              old_path, new_path)
+          tmp_dirs.extend(window_dirs)
+      timer = timings.start('tool')
+      try:
+        if single_file:
+          result = file_tool.run(old_path, new_path)
+        elif (tool.supports('recursive')):
+          result = tool.run(old_path, new_path)
+        else:
+          # Iterative diff, with (old, new) tree paths relative to the roots
+          # of the trees (old_path and new_path may be a file or subdir):
+          routed_ids = []
+          for file_ids in routed.values():
+            routed_ids.extend(file_ids)
+          path_list = changes.without(routed_ids).pairs()
+          if path_list or not routed:
+            result = tool.run(old_root, new_root, path_list)
+          for (tool_name, file_ids) in routed.items():
+            result = run_pairs(find_diff_tool(tool_name), old_root, new_root,
+                               changes.select(file_ids).pairs())
+      finally:
+        timings.stop(timer)
+
+      # Set the result, since external tools cannot be trusted to do so:
+      result = 1
+
+    except NoDifferencesFound:
+      result = 0
 
   finally:
-    release_read_locks(trees_to_lock)
+    # Remove the temporary files now, so the timings include the cleanup:
+    cleanup_tmp_dirs(tmp_dirs)
+
+  return result
+
 
+def unchanged_in_working_tree(file_list):
+  """
+  Check the files in a working tree against its basis, using the dirstate.
+
+  Return True only if the working tree keeps a dirstate, all the files
+  belong to it, and none of them has changed.  The dirstate holds the
+  basis inventory and the stat fingerprints of the files, so this needs
+  no repository access, and unchanged files are not even read.  In any
+  other case, return False, and leave it to compare_using to do the full
+  comparison (and report any errors).
+  """
   try:
-    # Use the 1st revision as the old version (basis_tree is the default):
-    if rev1:
-      old_tree = b1.repository.revision_tree(rev1.in_history(b1).rev_id)
-      old_hint = "-rev%s" % rev1.in_history(b1).revno
-    elif b2:
-      old_tree = work_tree1
-      old_hint = '-' + b1.nick
-    else:
-      old_tree = b1.basis_tree()
-      old_hint = "-basis"
+    (tree, rel_path) = workingtree.WorkingTree.open_containing(file_list[0])
+  except errors.BzrError:
+    return False
+  if not hasattr(tree, 'current_dirstate'):
+    return False
 
-    get_read_locks(trees_to_lock)
+  tree.lock_read()
+  try:
     try:
-      
-      # Use the 2nd revision as the new version (working_tree is the default):
-      if rev2:
-        new_tree = b1.repository.revision_tree(rev2.in_history(b1).rev_id)
-        delta = get_diffs_or_stop(old_tree, new_tree, file_ids1)
-        new_hint = "-rev%s" % rev2.in_history(b1).revno
-        new_tmp_dir = NamedTemporaryDir(tmp_prefix, new_hint, cleanup)
-        new_tmp_dir.write_stuff(new_tree, file_ids1, use_tree)
-        new_path = osutils.pathjoin(new_tmp_dir.path, adjust_path)
-      elif b2_in_working_tree:
-        # Files from two different branches, branch2 has a working tree:
-        delta = get_diffs_or_stop(old_tree, work_tree2, file_ids2)
-        if (len(file_list) == 1):
-          new_path = work_tree2.id2abspath(file_ids2[0])
-        else:
-          new_path = work_tree2.abspath('')
-      elif b2:
-        # Files from two different branches, branch2 has no working tree:
-        delta = get_diffs_or_stop(old_tree, work_tree2, file_ids2)
-        new_hint = '-' + b2.nick
-        new_tmp_dir = NamedTemporaryDir(tmp_prefix, new_hint, cleanup)
-        new_tmp_dir.write_stuff(work_tree2, file_ids2, use_tree)
-        new_path = osutils.pathjoin(new_tmp_dir.path, adjust_path)
-      elif not in_working_tree:
-        # Repository branch or remote branch, but only one revision:
-        new_tree = b1.basis_tree()
-        delta = get_diffs_or_stop(old_tree, new_tree, file_ids1)
-        new_hint = "-basis"
-        new_tmp_dir = NamedTemporaryDir(tmp_prefix, new_hint, cleanup)
-        new_tmp_dir.write_stuff(new_tree, file_ids1, use_tree)
-        new_path = osutils.pathjoin(new_tmp_dir.path, adjust_path)
-      else:
-        # Item(s) in working tree, just diff it in place:
-        delta = get_diffs_or_stop(old_tree, work_tree1, file_ids1)
-        if (len(file_list) == 1):
-          new_path = work_tree1.id2abspath(file_ids1[0])
-        else:
-          new_path = work_tree1.abspath('')
-  
-      # No exceptions yet, so we really do need to extract the old version:
-      if b2 and in_working_tree:
+      paths = [rel_path] + [tree.relpath(file_name)
+          for file_name in file_list[1:]]
+      basis = tree.basis_tree()
+      basis.lock_read()
+      try:
+        for change in tree.iter_changes(basis, specific_files=paths):
+          return False
+      finally:
+        basis.unlock()
+    except errors.BzrError:
+      return False
+  finally:
+    tree.unlock()
+
+  return True
+
+
+def compare_three_using(tool, file_list, base_spec, this_spec, other_spec):
+  """
+  Compare three revisions (base, this and other) using an external tool.
+
+  If the base revision spec is empty (e.g. '-r ..this..other'), the merge
+  base of the other two is used.  All three trees are extracted in one
+  locked pass: 'this' first, then 'other' and 'base', which clone any
+  text already written (or in a working tree) instead of reading it
+  from the repository again.  The tool decides the order of the paths,
+  with its 'threeway' capability (see DiffTool.run_threeway).
+  """
+  if not tool.supports('threeway'):
+    raise errors.BzrCommandError(
+        "%s does not support three-way comparisons" % tool.command)
+
+  session = TreeSession()
+  tmp_dirs = []
+  try:
+    try:
+      try:
+        timer = timings.start('open_trees')
+        try:
+          (b1, work_tree1, file_ids1, remainder) = session.open(file_list)
+          if (len(remainder) > 0):
+            raise errors.BzrCommandError(
+                "Cannot compare three revisions of multiple branches")
+        finally:
+          timings.stop(timer)
+
+        dir_kinds = ('directory', 'root_directory')
+        in_subdir = (session.kind(work_tree1, file_ids1[0]) in dir_kinds)
+        use_tree = not (len(file_list) == 1 and not in_subdir)
         if (len(file_list) == 1):
-          old_path = work_tree1.id2abspath(file_ids1[0])
+          adjust_path = session.id2path(work_tree1, file_ids1[0])
         else:
-          old_path = work_tree1.abspath('')
-      else:
-        old_tmp_dir = NamedTemporaryDir(tmp_prefix, old_hint, cleanup)
-        old_tmp_dir.write_stuff(old_tree, file_ids1, use_tree)
-        old_path = osutils.pathjoin(old_tmp_dir.path, adjust_path)
-    
-    finally:
-      # Release the locks before we start any interactive tools:
-      release_read_locks(trees_to_lock)
-
-    # Run the comparison:
-    if (tool.supports('recursive')):
-      result = tool.run(old_path, new_path)
-    elif (len(file_list) == 1 and not in_subdir):
-      result = tool.run(old_path, new_path)
-    else:
-      # Iterative diff:
-      if adjust_path != '':
-        path_list = [path.replace(adjust_path, '.', 1) 
-            for (path, file_id, kind, text_mods, meta_mods) in delta.modified
-            if text_mods]
-      else:
-        path_list = [path 
-            for (path, file_id, kind, text_mods, meta_mods) in delta.modified
-            if text_mods]
-      result = tool.run(old_path, new_path, path_list)
-
-    # Set the result, since external tools cannot be trusted to do so:
-    result = 1
+          adjust_path = ''
+        link_sources = [tree for tree in session.locked_trees
+            if isinstance(tree, workingtree.WorkingTree)]
+
+        timer = timings.start('resolve_revisions')
+        try:
+          trees = [('this', session.revision_tree(b1, this_spec),
+                    revision_hint(session, b1, this_spec, 'this')),
+                   ('other', session.revision_tree(b1, other_spec),
+                    revision_hint(session, b1, other_spec, 'other'))]
+          if base_spec.spec is None:
+            base_tree = session.revision_id_tree(b1,
+                session.merge_base(b1, this_spec, other_spec))
+          else:
+            base_tree = session.revision_tree(b1, base_spec)
+          trees.append(('base', base_tree, '-base'))
+        finally:
+          timings.stop(timer)
+
+        # Extract whatever changed from the base, on either side:
+        changes = None
+        for (name, tree, hint) in trees[:2]:
+          try:
+            side_changes = get_diffs_or_stop(base_tree, tree, file_ids1)
+          except NoDifferencesFound:
+            continue
+          if changes is None:
+            changes = side_changes
+          else:
+            changes = changes.union(side_changes)
+        if changes is None:
+          raise NoDifferencesFound
+
+        paths = {}
+        for (name, tree, hint) in trees:
+          tmp_dir = timings.timed('extract_' + name, write_tmp_dir, tool,
+              tree, file_ids1, hint, changes, use_tree, True,
+              tmp_dirs + link_sources)
+          tmp_dirs.append(tmp_dir)
+          tree_path = adjust_path
+          if adjust_path:
+            tree_path = session.tree_path(tree, file_ids1[0], adjust_path)
+          paths[name] = osutils.pathjoin(tmp_dir.path, tree_path)
+          if not use_tree and not osutils.lexists(paths[name]):
+            # Not in this tree (e.g. added on both sides since the base),
+            # so compare against an empty file, as the tools expect:
+            tmp_dir.write_empty(tree_path)
+
+      finally:
+        # Release the locks before we start any interactive tools:
+        session.close()
+
+      timings.timed('tool', tool.run_threeway, paths['base'], paths['this'],
+                    paths['other'])
+
+      # Set the result, since external tools cannot be trusted to do so:
+      result = 1
+
+    except NoDifferencesFound:
+      result = 0
 
-  except NoDifferencesFound:
-    result = 0
+  finally:
+    # Remove the temporary files now, so the timings include the cleanup:
+    cleanup_tmp_dirs(tmp_dirs)
 
   return result
 
 
-def get_tree_files(file_list):
+def revision_hint(session, branch, spec, name):
+  """
+  Return the suffix for the temporary directory of a revision spec.
+
+  Specs that are not in the branch history (e.g. 'branch:') have no
+  revno, so the name of the side is used instead.
+  """
+  revno = session.revision_info(branch, spec).revno
+  if revno is None:
+    return '-' + name
+  return '-rev%s' % revno
+
+
+def get_tree_files(file_list, keep_lock=False, possible_transports=None):
   """
   Get a tree, and the file_ids from that tree, from the inputs.
   
   This returns the tree (a working tree or basis tree), a list of the
   file_ids belonging to that tree, and a list of remaining files (that
-  presumably belong to another tree).
+  presumably belong to another tree).  If keep_lock is set, the tree is
+  returned read-locked, and the caller must unlock it.
+
+  For a remote branch, the other files are matched against the branch
+  URL, rather than opening the branch again for each of them, and any
+  connection in possible_transports is reused (new ones are added).
   """
 
   file_id_list = []
@@ -234,7 +628,8 @@ def get_tree_files(file_list):
     tree = branch1.basis_tree()
     base_path = osutils.normpath(branch1.base)
   except errors.NotLocalUrl:
-    (branch1, rel_path) = branch.Branch.open_containing(file_list[0])
+    (branch1, rel_path) = branch.Branch.open_containing(file_list[0],
+        possible_transports=possible_transports)
     tree = branch1.basis_tree()
     base_path = None
 
@@ -248,16 +643,15 @@ def get_tree_files(file_list):
           if base_path:
             rpath = osutils.relpath(base_path, file_name)
           else:
-            (branch2, rpath) = branch.Branch.open_containing(file_name)
-            if branch2.base != branch1.base:
-              raise errors.PathNotChild(file_name, branch1.base)
+            rpath = url_relpath(branch1.base, file_name)
         else:
           rpath = rel_path
         file_id = tree.inventory.path2id(rpath)
         if file_id:
           file_id_list.append(file_id)
         else:
-          if (not isinstance(transport.get_transport(file_name),
+          if (not isinstance(transport.get_transport(file_name,
+                                 possible_transports=possible_transports),
                              transport.local.LocalTransport)):
             raise errors.PathNotChild(file_name, branch1.base)
           else:
@@ -266,39 +660,151 @@ def get_tree_files(file_list):
       except errors.PathNotChild:
         break
         
-  finally:
+  except:
+    tree.unlock()
+    raise
+  if not keep_lock:
     tree.unlock()
 
   return (branch1, tree, file_id_list, file_list[i:len(file_list)])
 
 
-def get_diffs_or_stop(old_tree, new_tree, file_id_list):
+def url_relpath(base_url, url):
+  """
+  Return the path of a URL relative to a branch URL, without opening it.
+
+  Raise PathNotChild if the URL is not inside the branch (e.g. it is in
+  another branch, to be compared against this one).
+  """
+  base = urlutils.strip_trailing_slash(base_url)
+  target = urlutils.strip_trailing_slash(urlutils.normalize_url(url))
+  if target == base:
+    return ''
+  if not target.startswith(base + '/'):
+    raise errors.PathNotChild(url, base_url)
+
+  return urlutils.unescape(target[len(base) + 1:])
+
+
+def get_diffs_or_stop(old_tree, new_tree, file_id_list, router=None):
   """
   Use Tree.changes_from() to check if there is work to do.
   
-  This can return 'delta' even if no text modifications were found,
-  since some tools (especially recursive tree diffs) can do something
-  useful with additions/deletions/renames.
+  This returns a ChangeIndex of the changes, even if no text
+  modifications were found, since some tools (especially recursive tree
+  diffs) can do something useful with additions/deletions/renames.
+
+  If a Router is given, each text change is routed before anything is
+  extracted, and skipped files are left out of the ChangeIndex; if only
+  skipped files had text changes, there is nothing to do.
   """
   path_list = [new_tree.id2path(file_id) 
       for file_id in file_id_list 
       if new_tree.has_id(file_id)]
 
+  timer = timings.start('changes_from')
   delta = new_tree.changes_from(old_tree, specific_files=path_list)
+  timings.stop(timer)
   if ((len(delta.removed) + len(delta.added) + 
        len(delta.renamed) + len(delta.modified)) == 0):
     raise NoDifferencesFound
+
+  changes = ChangeIndex(delta)
+  if router:
+    changes = router.route(changes, old_tree, new_tree)
+    if changes.skipped and not changes.text_changes():
+      raise NoDifferencesFound
   
-  return delta
+  return changes
 
 
-def get_read_locks(tree_list):
+def write_tmp_dir(tool, tree, file_ids, hint, changes, use_tree,
+                  both_extracted, link_sources):
   """
-  Call tree.lock_read() on a list of trees.
+  Extract (part of) a tree to a new temporary directory, and return it.
+
+  The tool capabilities decide how much of the tree is written, and how:
+
+    'stream'  a single file is streamed through a named pipe;
+    'sparse'  only the changed entries of a tree are written (the
+              default for a tool that is only given the changed files,
+              or when both sides of the comparison are extracted; a
+              sparse tree next to a full working tree would show every
+              unchanged file as an addition in a recursive tool).
   """
-  for tree in tree_list:
-    tree.lock_read()
-    
+  tmp_dir = NamedTemporaryDir(TMP_PREFIX, hint, tool.supports('cleanup'))
+  for source in link_sources:
+    tmp_dir.add_link_source(source)
+
+  sparse = tool.supports('sparse')
+  if sparse is None:
+    sparse = both_extracted or not tool.supports('recursive')
+
+  if changes.skipped:
+    file_ids = [file_id for file_id in file_ids
+        if file_id not in changes.skipped]
+
+  if not use_tree:
+    if tool.supports('stream') and len(file_ids) == 1:
+      tmp_dir.write_pipes(tree, file_ids)
+    else:
+      tmp_dir.write_files(tree, file_ids)
+  elif sparse:
+    tmp_dir.write_changes(tree, file_ids, changes)
+  else:
+    tmp_dir.write_tree(tree, file_ids, changes.skipped)
+
+  return tmp_dir
+
+
+def window_large_files(tool, old_path, new_path):
+  """
+  Replace a very large pair of files with windowed copies (see window.py).
+
+  Return the (old, new) paths to compare, and a list of any temporary
+  directories created, which must be kept until the tool is done.
+  """
+  min_size = window.get_window_size()
+  if not (min_size and window.needs_window(old_path, new_path, min_size)):
+    return (old_path, new_path, [])
+
+  timer = timings.start('window')
+  try:
+    tmp_dirs = [NamedTemporaryDir(TMP_PREFIX, hint, tool.supports('cleanup'))
+        for hint in ('-window-old', '-window-new')]
+    old_copy = osutils.pathjoin(tmp_dirs[0].path, osutils.basename(old_path))
+    new_copy = osutils.pathjoin(tmp_dirs[1].path, osutils.basename(new_path))
+    window.write_windows(old_path, new_path, old_copy, new_copy)
+  finally:
+    timings.stop(timer)
+
+  return (old_copy, new_copy, tmp_dirs)
+
+
+def run_pairs(tool, old_path, new_path, path_list):
+  """
+  Run a tool on a list of (old, new) pairs, relative to two directories.
+
+  A list tool is given the whole list; any other tool is run on each
+  pair in turn.
+  """
+  if not tool.supports('recursive'):
+    return tool.run(old_path, new_path, path_list)
+
+  result = 0
+  for (old_file, new_file) in path_list:
+    result = tool.run(osutils.pathjoin(old_path, old_file),
+                      osutils.pathjoin(new_path, new_file))
+  return result
+
+
+def cleanup_tmp_dirs(tmp_dirs):
+  """
+  Clean up a list of temporary directories, once the tool is done with them.
+  """
+  for tmp_dir in tmp_dirs:
+    tmp_dir.cleanup()
+
   return
 
 
@@ -315,17 +821,29 @@ def release_read_locks(tree_list):
 # Initialize the module:
 
 # Register known diff tools, and provide exemplars for later cloning:
+register_diff_tool(EmacsDiffTool('emacsclient'))
 register_diff_tool(TreeDiffTool('fldiff'))
-register_diff_tool(ListDiffTool('gvim', diff_options='-f -d'))
-register_diff_tool(ListDiffTool('gvimdiff', diff_options='-f'))
-register_diff_tool(TreeDiffTool('kdiff3'))
+register_diff_tool(HtmlDiffTool('internal-html'))
+register_diff_tool(JsonReportTool('internal-json'))
+register_diff_tool(SideBySideDiffTool('internal-sidebyside'))
+register_diff_tool(InternalDiffTool('internal-unified'))
+register_diff_tool(VimBatchDiffTool('gvim', diff_options='-f'))
+register_diff_tool(VimBatchDiffTool('gvimdiff', diff_options='-f'))
+register_diff_tool(VimServerDiffTool('gvim-server', program='gvim'))
+register_diff_tool(TreeDiffTool('kdiff3', threeway=('base', 'this', 'other')))
 register_diff_tool(TreeDiffTool('kompare'))
-register_diff_tool(TreeDiffTool('meld'))
+register_diff_tool(TreeDiffTool('meld', threeway=('this', 'base', 'other')))
+register_diff_tool(ServerDiffTool('meld-tab', program='meld',
+                                  remote_options='--newtab', recursive=True))
 register_diff_tool(ListDiffTool('mgdiff'))
 register_diff_tool(TreeDiffTool('opendiff', cleanup=False))
+register_diff_tool(ListDiffTool('udiff', program='diff', diff_options='-u',
+                                interactive=False, concurrent=True,
+                                old_first=True))
 register_diff_tool(ListDiffTool('tkdiff'))
 register_diff_tool(ListDiffTool('vim', diff_options='-d'))
 register_diff_tool(ListDiffTool('vimdiff'))
-register_diff_tool(TreeDiffTool('xxdiff', diff_options='--exclude=.bzr*'))
+register_diff_tool(TreeDiffTool('xxdiff', diff_options='--exclude=.bzr*',
+                                threeway=('this', 'base', 'other')))
 
 # The End.
@@ -0,0 +1,64 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+The extended 'bzr diff' command
+
+This module is only imported when the 'diff' command is actually used
+(see the lazy registration in __init__.py), since it needs the builtin
+commands and options, which are expensive to import.
+"""
+
+from bzrlib import (
+    builtins,
+    option,
+    )
+
+
+class cmd_diff(builtins.cmd_diff):
+  """
+  The '--using TOOL' option can be used to run an external diff tool.
+
+  Some examples of supported diff tools include 'kdiff3', 'kompare', 
+  'meld', 'vimdiff', and 'xxdiff'.  Other external diff tools are likely
+  to work as well, as long as their basic arguments are in the same form
+  as 'diff'.
+  
+  Most of these tools allow merging or editing, so they can be used to
+  change the working copy, but this should be done carefully.  Changes 
+  to temporary files will not be saved.
+  
+  External diff tools may need customization to filter out the '.bzr'
+  control files.
+  """
+
+  # Add a new option to the builtin 'diff' command:
+  takes_options = builtins.cmd_diff.takes_options + [
+           option.Option('using', type=str, help='Use alternate diff tool.')]
+
+  # Override the inherited run() and help() methods:
+
+  def run(self, *args, **kwargs):
+    """
+    Choose which diff tool (external or builtin) to run.
+    """
+    from controller import Controller
+    if 'using' in kwargs:
+      # Run the specified external diff tool:
+      return Controller().run(*args, **kwargs)
+    else:
+      # Run the builtin diff command normally:
+      return super(cmd_diff, self).run(*args, **kwargs)
+
+
+  def help(self):
+    """
+    Return help message for this class, including text from superclass.
+    """
+    from inspect import getdoc
+    return getdoc(super(cmd_diff, self)) + '\n\n' + getdoc(self)
+
+  # End class cmd_diff
+
+# The End.
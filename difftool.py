@@ -18,10 +18,15 @@ registered:
 These initial options will be inherited by all later instances of the
 tool named 'diff', because they will all be clones of this instance.
 
-Two subclasses are currently defined:  
+Several subclasses are currently defined:  
    
-   TreeDiffTool  (for recursive tree diffs like 'meld' and 'kompare')
-   ListDiffTool  (for non-recursive tools like 'vimdiff' and 'mgdiff')
+   TreeDiffTool      (for recursive tree diffs like 'meld' and 'kompare')
+   ListDiffTool      (for non-recursive tools like 'vimdiff' and 'mgdiff')
+   BatchDiffTool     (for list tools that accept many file pairs at once)
+   VimBatchDiffTool  (for VIM, opening each file pair in a tab page)
+   ServerDiffTool    (for tools that send diffs to a running instance)
+   VimServerDiffTool (for GVIM, using its client-server feature)
+   EmacsDiffTool     (for Emacs ediff, via emacsclient)
 
 Additional keyword arguments can be provided at initialization, to
 record details about the supported capabilities for this tool.  The 
@@ -31,12 +36,25 @@ following fields are currently recognized for DiffTool and subclasses:
    'interactive'
    'diff'
    'cleanup'
+   'sparse'
+   'concurrent'
+   'batch'
+   'stream'
+   'server'
+   'threeway'
+   'program'
+   'old_first'
    
 These are generally set by default for particular DiffTool subclasses,
 but can be changed for the parent class, like:
   
    register_diff_tool(DiffTool('vimdiff', recursive=False)
 
+A tool registered under a name of its own (e.g. a server variant of
+an existing tool) names its executable with 'program':
+
+   register_diff_tool(VimServerDiffTool('gvim-server', program='gvim'))
+
 These capabilities can be queried (or overridden) using the 'supports'
 method:
   
@@ -56,11 +74,32 @@ diffs one at a time:
 instead of an instance of DiffTool itself.
 """
 
+import os
+import shutil
 import subprocess
+import sys
+import time
 from os.path import join
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
 
 from externtool import ExternalTool
+import timings
+
+
+# The order of the paths for tools that set 'threeway' to True:
+DEFAULT_THREEWAY_ORDER = ('base', 'this', 'other')
+
+# Number of processes for tools that set 'concurrent' to True:
+DEFAULT_CONCURRENCY = 4
+
+# Seconds to wait between checks on running processes:
+POLL_INTERVAL = 0.01
+
+# Seconds to wait for a newly started tool server to accept requests:
+SERVER_TIMEOUT = 10
+
+# Seconds to wait between checks on a tool server that is starting up:
+SERVER_POLL_INTERVAL = 0.1
 
   
 class DiffTool(ExternalTool):
@@ -99,11 +138,38 @@ class DiffTool(ExternalTool):
     # clutter that some GUI apps spew when run from the shell.
     temp_log = NamedTemporaryFile(suffix='.log', prefix='bzr_' + self.command)
 
-    run_tool = [self.command] + diff_opts + [old_path, new_path]
-    result = subprocess.call(run_tool, stderr=temp_log)
+    run_tool = [self.executable()] + diff_opts + [old_path, new_path]
+    result = call_tool(run_tool, stderr=temp_log)
     
     return result
 
+  def run_threeway(self, base_path, this_path, other_path):
+    """
+    Execute the command on three paths, return the result.
+
+    The 'threeway' capability gives the order of the paths, as a tuple of
+    'base', 'this' and 'other' (or True, for DEFAULT_THREEWAY_ORDER).
+    """
+    if self.options:
+      diff_opts = self.options.split()
+    else:
+      diff_opts = []
+
+    order = self.supports('threeway')
+    if order is True:
+      order = DEFAULT_THREEWAY_ORDER
+    paths = {'base': base_path, 'this': this_path, 'other': other_path}
+
+    # Redirect stderr to a temp log, so we are not bothered by the useless
+    # clutter that some GUI apps spew when run from the shell.
+    temp_log = NamedTemporaryFile(suffix='.log', prefix='bzr_' + self.command)
+
+    run_tool = [self.executable()] + diff_opts + [paths[name]
+        for name in order]
+    result = call_tool(run_tool, stderr=temp_log)
+
+    return result
+
   # End class DiffTool
 
 
@@ -132,7 +198,13 @@ class ListDiffTool(DiffTool):
   Subclass of DiffTool for tools that work with lists, not recursive trees.
   
   Examples include VIM and mgdiff.  These tools also prefer to put the new
-  path first, so the operands are swapped here.
+  path first, so the operands are swapped here, unless the tool sets the
+  'old_first' capability (e.g. 'diff').
+
+  Non-interactive tools can set the 'concurrent' capability to the number
+  of tool processes to run at once (or True, for a default number).  The
+  output still appears in file order, and the exit code for each file is
+  kept in the 'results' attribute as a list of (path, code) pairs.
   """
 
   def __init__(self, name, diff_options='', **kwargs):
@@ -147,14 +219,8 @@ class ListDiffTool(DiffTool):
     """
     Execute the command, return the result.
     """
-    
-    # Get confirmation before diffing the entire world:
-    if self.supports('interactive'):
-      if (file_list and len(file_list) > 1):
-        print "There are %d files with differences to review" % len(file_list)
-        val = raw_input('Do you wish to continue [Y/n]? ')
-        if val.lower() in ('n', 'no'):
-          return 1
+    if not self.confirm(file_list):
+      return 1
 
     if self.options:
       diff_opts = self.options.split()
@@ -167,20 +233,482 @@ class ListDiffTool(DiffTool):
 
     if (file_list and len(file_list) > 0):
       # Run the diff tool iteratively, just changing the paths on each call:
-      for path in file_list:
-        run_tool = [self.command] + diff_opts + [join(new_path, path),
-            join(old_path, path)]
-        result = subprocess.call(run_tool, stderr=temp_log)
+      run_tools = [[self.executable()] + diff_opts +
+                   self.operands(new_file, old_file)
+          for (new_file, old_file) in
+              self.file_pairs(old_path, new_path, file_list)]
+      max_procs = self.supports('concurrent')
+      if max_procs is True:
+        max_procs = DEFAULT_CONCURRENCY
+      if max_procs and max_procs > 1:
+        results = run_concurrently(run_tools, max_procs, stderr=temp_log)
+      else:
+        results = [call_tool(run_tool, stderr=temp_log)
+            for run_tool in run_tools]
+      self.results = zip(file_list, results)
+      result = results[-1]
     else:
       # Just one diff to run, no need for games with the input paths:
-      run_tool = [self.command] + diff_opts + [new_path, old_path]
-      result = subprocess.call(run_tool, stderr=temp_log)
+      run_tool = ([self.executable()] + diff_opts +
+                  self.operands(new_path, old_path))
+      result = call_tool(run_tool, stderr=temp_log)
     
     return result
+
+  def operands(self, new_path, old_path):
+    """
+    Return the two paths in the order the tool expects them.
+    """
+    if self.supports('old_first'):
+      return [old_path, new_path]
+    return [new_path, old_path]
+
+  def file_pairs(self, old_path, new_path, file_list):
+    """
+    Return the (new, old) file paths for each entry in file_list.
+
+    Each entry is either a path relative to both directories, or an
+    (old, new) pair of relative paths (e.g. for a renamed file).
+    """
+    pairs = []
+    for path in file_list:
+      if isinstance(path, tuple):
+        (old_file, new_file) = path
+      else:
+        old_file = new_file = path
+      pairs.append((join(new_path, new_file), join(old_path, old_file)))
+
+    return pairs
+
+  def confirm(self, file_list):
+    """
+    Get confirmation before diffing the entire world, return False to stop.
+    """
+    if self.supports('interactive'):
+      if (file_list and len(file_list) > 1):
+        print "There are %d files with differences to review" % len(file_list)
+        val = raw_input('Do you wish to continue [Y/n]? ')
+        if val.lower() in ('n', 'no'):
+          return False
+
+    return True
   
   # End class ListDiffTool
 
 
+class BatchDiffTool(ListDiffTool):
+  """
+  Subclass of ListDiffTool for tools that can open many file pairs at once.
+
+  Instead of running the tool once per file, all of the (new, old) pairs
+  are passed to a single tool process, as consecutive arguments.  If the
+  command line would be too long for the OS, the pairs are split into
+  as few batches as possible, one tool process per batch.
+
+  Tools that need something other than a flat list of arguments (e.g. a
+  generated script) can override the batches() and run_batch() methods.
+  """
+
+  def __init__(self, name, diff_options='', **kwargs):
+    """
+    Initialize a BatchDiffTool object with the command and default options.
+    """
+    super(BatchDiffTool, self).__init__(name, diff_options, **kwargs)
+    self.supports('batch', True)
+    return
+
+  def run(self, old_path, new_path, file_list=None):
+    """
+    Execute the command (once per batch), return the result.
+    """
+    if not self.confirm(file_list):
+      return 1
+
+    if self.options:
+      diff_opts = self.options.split()
+    else:
+      diff_opts = []
+
+    # Redirect stderr to a temp log, so we are not bothered by the useless
+    # clutter that some GUI apps spew when run from the shell.
+    temp_log = NamedTemporaryFile(suffix='.log', prefix='bzr_' + self.command)
+
+    if file_list:
+      pairs = self.file_pairs(old_path, new_path, file_list)
+    else:
+      pairs = [(new_path, old_path)]
+    run_tool = [self.executable()] + diff_opts
+    for batch in self.batches(run_tool, pairs):
+      result = self.run_batch(run_tool, batch, temp_log)
+
+    return result
+
+  def batches(self, run_tool, pairs):
+    """
+    Split the list of pairs into batches that fit on one command line.
+    """
+    limit = max_command_length()
+    base_length = sum([len(arg) + 1 for arg in run_tool])
+    batches = []
+    batch = []
+    length = base_length
+    for (new_file, old_file) in pairs:
+      pair_length = len(new_file) + len(old_file) + 2
+      if batch and length + pair_length > limit:
+        batches.append(batch)
+        batch = []
+        length = base_length
+      batch.append((new_file, old_file))
+      length += pair_length
+    if batch:
+      batches.append(batch)
+
+    return batches
+
+  def run_batch(self, run_tool, pairs, stderr):
+    """
+    Run one tool process for a batch of (new, old) pairs.
+    """
+    args = []
+    for (new_file, old_file) in pairs:
+      args.extend([new_file, old_file])
+    return call_tool(run_tool + args, stderr=stderr)
+
+  # End class BatchDiffTool
+
+
+class VimBatchDiffTool(BatchDiffTool):
+  """
+  Subclass of BatchDiffTool for VIM, using one tab page per file pair.
+
+  VIM cannot take the pairs as arguments, so a script is generated that
+  opens each pair in a new tab page (in diff mode), and VIM is told to
+  source it.  Since the command line does not grow with the number of
+  pairs, everything fits in a single batch.
+  """
+
+  def batches(self, run_tool, pairs):
+    """
+    Put all the pairs in one batch, since they are passed in a script.
+    """
+    return [pairs]
+
+  def run_batch(self, run_tool, pairs, stderr):
+    """
+    Write a VIM script that opens every pair, and run VIM on it.
+    """
+    script = NamedTemporaryFile(suffix='.vim', prefix='bzr_' + self.command)
+    first = True
+    for (new_file, old_file) in pairs:
+      if first:
+        script.write("execute 'edit ' . fnameescape(%s)\n" %
+                     vim_string(new_file))
+        first = False
+      else:
+        script.write("execute 'tabnew ' . fnameescape(%s)\n" %
+                     vim_string(new_file))
+      script.write("execute 'vertical diffsplit ' . fnameescape(%s)\n" %
+                   vim_string(old_file))
+    script.write('tabfirst\n')
+    script.flush()
+
+    return call_tool(run_tool + ['-S', script.name], stderr=stderr)
+
+  # End class VimBatchDiffTool
+
+
+class ServerDiffTool(ListDiffTool):
+  """
+  Subclass of ListDiffTool for tools that can keep running as a server.
+
+  Starting a GUI tool can take a few seconds, so a tool that supports it
+  is started once, in server mode, and later comparisons are sent to the
+  running instance instead (e.g. to open in a new tab), which is much
+  quicker.  Since the tool does not wait for the user, the temporary
+  files must outlive this command, so 'cleanup' is off by default (the
+  temporary directories are left for the reaper, which removes them once
+  they are a day old).  If a new server never comes up, each of the remaining
+  comparisons is shown by starting the tool again instead.
+
+  Subclasses say how to detect a running server, how to start one, and
+  how to send it a comparison, by overriding server_running(),
+  start_command() and remote_command().  By default, the tool is assumed
+  to find (or become) the server itself, e.g. 'meld --newtab', so only
+  the remote command is used, with remote_options before the others.
+  """
+
+  def __init__(self, name, diff_options='', remote_options='', **kwargs):
+    """
+    Initialize a ServerDiffTool object with the command and default options.
+    """
+    if 'cleanup' not in kwargs:
+      kwargs['cleanup'] = False
+    recursive = kwargs.get('recursive', False)
+    super(ServerDiffTool, self).__init__(name, diff_options, **kwargs)
+    self.supports('recursive', recursive)
+    self.supports('server', True)
+    self.remote_options = remote_options
+    return
+
+  def run(self, old_path, new_path, file_list=None):
+    """
+    Send each comparison to the server, starting it first if necessary.
+    """
+    if not self.confirm(file_list):
+      return 1
+
+    # Redirect stderr to a temp log, so we are not bothered by the useless
+    # clutter that some GUI apps spew when run from the shell.
+    temp_log = NamedTemporaryFile(suffix='.log', prefix='bzr_' + self.command)
+
+    if file_list:
+      pairs = self.file_pairs(old_path, new_path, file_list)
+    else:
+      pairs = [(new_path, old_path)]
+
+    if not self.server_running():
+      (new_file, old_file) = pairs.pop(0)
+      result = call_tool(self.start_command(new_file, old_file),
+                         stderr=temp_log)
+      if pairs and not self.wait_for_server():
+        # Nothing to send the rest to, so show each one the same way:
+        for (new_file, old_file) in pairs:
+          result = call_tool(self.start_command(new_file, old_file),
+                             stderr=temp_log)
+        return result
+    for (new_file, old_file) in pairs:
+      result = call_tool(self.remote_command(new_file, old_file),
+                         stderr=temp_log)
+
+    return result
+
+  def server_running(self):
+    """
+    Check if a server is already running.
+    """
+    return True
+
+  def wait_for_server(self):
+    """
+    Wait for a new server to start, return False if it never does.
+    """
+    deadline = time.time() + SERVER_TIMEOUT
+    while not self.server_running():
+      if time.time() > deadline:
+        return False
+      time.sleep(SERVER_POLL_INTERVAL)
+
+    return True
+
+  def start_command(self, new_file, old_file):
+    """
+    Return the command that starts a server, showing the first comparison.
+    """
+    return self.remote_command(new_file, old_file)
+
+  def remote_command(self, new_file, old_file):
+    """
+    Return the command that sends a comparison to the running server.
+    """
+    return ([self.executable()] + self.remote_options.split() +
+            self.options.split() + [old_file, new_file])
+
+  # End class ServerDiffTool
+
+
+class VimServerDiffTool(ServerDiffTool):
+  """
+  Subclass of ServerDiffTool for GVIM, using its client-server feature.
+
+  The first comparison starts GVIM with a known server name, and each
+  later one is sent to it as keystrokes, to open a new tab page in diff
+  mode.  GVIM forks itself when it starts, so it never blocks bzr.
+  """
+
+  def __init__(self, name, diff_options='', server_name='BZRDIFF', **kwargs):
+    """
+    Initialize a VimServerDiffTool object with the command and options.
+    """
+    super(VimServerDiffTool, self).__init__(name, diff_options, **kwargs)
+    self.server_name = server_name
+    return
+
+  def server_running(self):
+    """
+    Check if VIM lists our server name (server names ignore case).
+    """
+    devnull = open(os.devnull, 'w')
+    try:
+      timings.count('spawns')
+      try:
+        proc = subprocess.Popen([self.executable(), '--serverlist'],
+                                stdout=subprocess.PIPE, stderr=devnull)
+        output = proc.communicate()[0]
+      except OSError:
+        return False
+    finally:
+      devnull.close()
+
+    servers = [line.strip().upper() for line in output.splitlines()]
+    return self.server_name.upper() in servers
+
+  def start_command(self, new_file, old_file):
+    """
+    Return the command that starts GVIM as a server, in diff mode.
+    """
+    return ([self.executable(), '--servername', self.server_name] +
+            self.options.split() + ['-d', new_file, old_file])
+
+  def remote_command(self, new_file, old_file):
+    """
+    Return the command that opens a new diff tab page in the server.
+    """
+    keys = ("<C-\\><C-N>:execute 'tabnew ' . fnameescape(%s)"
+            " | execute 'vertical diffsplit ' . fnameescape(%s)<CR>" %
+            (vim_keys(vim_string(new_file)), vim_keys(vim_string(old_file))))
+    return [self.executable(), '--servername', self.server_name,
+            '--remote-send', keys]
+
+  # End class VimServerDiffTool
+
+
+class EmacsDiffTool(ServerDiffTool):
+  """
+  Subclass of ServerDiffTool for Emacs ediff, via emacsclient.
+
+  If no Emacs server is running, emacsclient is told to start a daemon
+  (and a frame for it); each comparison is then an ediff session in that
+  Emacs.
+  """
+
+  def server_running(self):
+    """
+    Check if emacsclient can reach a server (without starting one).
+    """
+    devnull = open(os.devnull, 'w')
+    try:
+      try:
+        result = call_tool([self.executable(), '--alternate-editor=false',
+                            '--eval', 't'], stdout=devnull, stderr=devnull)
+      except OSError:
+        return False
+    finally:
+      devnull.close()
+
+    return result == 0
+
+  def start_command(self, new_file, old_file):
+    """
+    Return the command that starts an Emacs daemon, showing the first diff.
+    """
+    return ([self.executable(), '--alternate-editor=', '--create-frame'] +
+            self.remote_command(new_file, old_file)[1:])
+
+  def remote_command(self, new_file, old_file):
+    """
+    Return the command that starts an ediff session in the server.
+    """
+    return ([self.executable(), '--no-wait'] + self.options.split() +
+            ['--eval', '(ediff-files %s %s)' % (lisp_string(old_file),
+                                                lisp_string(new_file))])
+
+  # End class EmacsDiffTool
+
+
+def call_tool(run_tool, **kwargs):
+  """
+  Run a tool and wait for it (like subprocess.call), counting the spawn.
+  """
+  timings.count('spawns')
+  return subprocess.call(run_tool, **kwargs)
+
+
+def run_concurrently(run_tools, max_procs, stderr=None):
+  """
+  Run a list of commands, with up to max_procs of them running at once.
+
+  The output of each command is collected in a temporary file, and copied
+  to stdout in list order, so it does not depend on the order in which
+  the commands happen to finish.  Return the list of exit codes, in the
+  same order as the commands.
+  """
+  results = [None] * len(run_tools)
+  outputs = [None] * len(run_tools)
+  running = []
+  next_job = 0
+  next_output = 0
+  while next_output < len(run_tools):
+    # Start as many new processes as we are allowed:
+    while next_job < len(run_tools) and len(running) < max_procs:
+      outputs[next_job] = TemporaryFile()
+      timings.count('spawns')
+      proc = subprocess.Popen(run_tools[next_job], stdout=outputs[next_job],
+                              stderr=stderr)
+      running.append((next_job, proc))
+      next_job += 1
+
+    # Collect the exit codes of any finished processes:
+    finished = [(job, proc) for (job, proc) in running
+        if proc.poll() is not None]
+    for (job, proc) in finished:
+      results[job] = proc.returncode
+      running.remove((job, proc))
+    if not finished:
+      time.sleep(POLL_INTERVAL)
+
+    # Copy the output of finished processes, but only in list order:
+    while next_output < len(run_tools) and results[next_output] is not None:
+      outputs[next_output].seek(0)
+      shutil.copyfileobj(outputs[next_output], sys.stdout)
+      outputs[next_output].close()
+      outputs[next_output] = None
+      next_output += 1
+  sys.stdout.flush()
+
+  return results
+
+
+def max_command_length():
+  """
+  Return a safe upper limit for the length of a command line, in bytes.
+
+  The OS limit (ARG_MAX) also covers the environment, so that is taken
+  off, along with a little headroom for the pointers to each string.
+  """
+  try:
+    limit = os.sysconf('SC_ARG_MAX')
+  except (AttributeError, ValueError, OSError):
+    # The limit for CreateProcess on Windows:
+    limit = 32767
+  if limit <= 0:
+    limit = 32767
+  env_length = sum([len(key) + len(value) + 2
+      for (key, value) in os.environ.items()])
+
+  return max(limit - env_length - 4096, 4096)
+
+
+def vim_string(text):
+  """
+  Quote a string as a literal VIM string.
+  """
+  return "'" + text.replace("'", "''") + "'"
+
+
+def vim_keys(text):
+  """
+  Escape text for VIM's --remote-send, where '<' starts a key name.
+  """
+  return text.replace('<', '<lt>')
+
+
+def lisp_string(text):
+  """
+  Quote a string as an Emacs Lisp string.
+  """
+  return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
 def register_diff_tool(tool):
   """
   Register a known diff tool, using an exemplar of its class.
@@ -206,7 +734,7 @@ def find_diff_tool(name):
   tool = ExternalTool.find('diff', name)
   if not tool:
     tool = TreeDiffTool(name)
-    ExternalTool.check_path(name)
+    tool.path = ExternalTool.check_path(name)
 
   return tool
 
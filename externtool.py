@@ -11,8 +11,9 @@ Bazaar (bzr).
 
 import subprocess
 import copy
-from os.path import join, isfile
-from os import pathsep, environ
+from os.path import abspath, dirname, join, isdir, isfile
+from os import (access, environ, getpid, makedirs, pathsep, remove, rename,
+                stat, X_OK)
 
 from bzrlib import errors
 
@@ -34,6 +35,9 @@ class ExternalTool(object):
   'supports' method.  Almost anything can be stored as a capability,
   but this mechanism is most often used for simple flags, e.g. 
   {'recursive': True}.
+
+  The 'program' capability names the executable, for a tool that is
+  registered under a name of its own, e.g. {'program': 'gvim'}.
   """
   
   # Keep a dictionary of known tools {kind : {tool: exemplar_instance}}:
@@ -79,7 +83,7 @@ class ExternalTool(object):
     else:
       opts = []
 
-    run_tool = [self.command] + opts
+    run_tool = [self.executable()] + opts
     return subprocess.call(run_tool)
 
   @staticmethod
@@ -110,7 +114,10 @@ class ExternalTool(object):
     if kind in ExternalTool.known_tools:
       if name in ExternalTool.known_tools[kind]:
         tool = copy.copy(ExternalTool.known_tools[kind][name])
-        ExternalTool.check_path(tool.command)
+        # Tools that run inside bzr have no executable to find:
+        if not tool.supports('internal'):
+          tool.path = ExternalTool.check_path(tool.supports('program') or
+                                              tool.command)
     
     return tool
 
@@ -118,17 +125,154 @@ class ExternalTool(object):
   def check_path(name):
     """
     Check if this tool is actually available on this system.
+
+    Return the absolute path of the executable, which is looked up in
+    the ToolPathCache before falling back to a scan of $PATH.
     """
-    found = False
     exe_path = environ.get('PATH', '')
-    for path in exe_path.split(pathsep):
-      if path and isfile(join(path, name)):
-        found = True
-    if not found:
-      raise errors.BzrError("Cannot find '%s' in %s" % (name, exe_path))
+    tool_paths = ToolPathCache.get()
+    abs_path = tool_paths.lookup(name, exe_path)
+    if abs_path:
+      return abs_path
 
-    return
+    dirs = [path for path in exe_path.split(pathsep) if path]
+    for (i, path) in enumerate(dirs):
+      if is_executable(join(path, name)):
+        abs_path = abspath(join(path, name))
+        tool_paths.record(name, exe_path, abs_path, dirs[:i + 1])
+        return abs_path
+
+    raise errors.BzrError("Cannot find '%s' in %s" % (name, exe_path))
+
+  def executable(self):
+    """
+    Return the command to execute: the absolute path, if it is known.
+    """
+    return (getattr(self, 'path', None) or self.supports('program') or
+            self.command)
 
   # End class ExternalTool
 
+
+class ToolPathCache(object):
+  """
+  Persistent cache of the absolute paths of external tools.
+
+  Scanning every directory in $PATH can be slow (e.g. on NFS), so the
+  result of each scan is kept in a file in the bzr configuration
+  directory.  Each entry records the value of $PATH, and the mtime of
+  each directory that was searched before the tool was found, so the
+  entry is ignored as soon as $PATH changes, or a tool of the same name
+  could have been added (or removed) earlier in the search order.
+  """
+
+  _instance = None
+
+  def __init__(self, cache_file):
+    """
+    Load the cache from a file (the file need not exist yet).
+    """
+    self.cache_file = cache_file
+    self.entries = {}
+    try:
+      f = open(cache_file, 'rb')
+    except IOError:
+      return
+    try:
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) >= 3:
+          self.entries[fields[0]] = (fields[1], fields[2], fields[3:])
+    finally:
+      f.close()
+    return
+
+  @staticmethod
+  def get():
+    """
+    Return the shared cache for this process.
+    """
+    if ToolPathCache._instance is None:
+      from bzrlib import config
+      ToolPathCache._instance = ToolPathCache(
+          join(config.config_dir(), 'difftools', 'tools.cache'))
+    return ToolPathCache._instance
+
+  def lookup(self, name, exe_path):
+    """
+    Return the cached path for a tool, or None if it may be out of date.
+    """
+    if name not in self.entries:
+      return None
+    (cached_path, abs_path, dir_stamps) = self.entries[name]
+    if cached_path != exe_path:
+      return None
+    for stamp in dir_stamps:
+      (directory, mtime) = stamp.rsplit(' ', 1)
+      if dir_mtime(directory) != mtime:
+        return None
+    if not is_executable(abs_path):
+      return None
+
+    return abs_path
+
+  def record(self, name, exe_path, abs_path, dirs):
+    """
+    Record where a tool was found, and save the cache.
+    """
+    dir_stamps = ['%s %s' % (directory, dir_mtime(directory))
+        for directory in dirs]
+    self.entries[name] = (exe_path, abs_path, dir_stamps)
+    try:
+      self._save()
+    except (IOError, OSError):
+      # The cache is only an optimization, so do without it:
+      pass
+    return
+
+  # Private Methods:
+
+  def _save(self):
+    """
+    Write the cache file, replacing it atomically.
+    """
+    cache_dir = dirname(self.cache_file)
+    if not isdir(cache_dir):
+      makedirs(cache_dir)
+    tmp_file = '%s.%d.tmp' % (self.cache_file, getpid())
+    f = open(tmp_file, 'wb')
+    try:
+      for (name, (exe_path, abs_path, dir_stamps)) in self.entries.items():
+        f.write('\t'.join([name, exe_path, abs_path] + dir_stamps) + '\n')
+    finally:
+      f.close()
+    try:
+      rename(tmp_file, self.cache_file)
+    except OSError:
+      # Windows will not rename over an existing file:
+      remove(self.cache_file)
+      rename(tmp_file, self.cache_file)
+    return
+
+  # End class ToolPathCache
+
+
+# Functions:
+
+def is_executable(path):
+  """
+  Check if a path is a file that we are allowed to execute.
+  """
+  return isfile(path) and access(path, X_OK)
+
+
+def dir_mtime(directory):
+  """
+  Return the mtime of a directory as a string ('-' if it is missing).
+  """
+  try:
+    return repr(stat(directory).st_mtime)
+  except OSError:
+    return '-'
+
 # The End.
@@ -0,0 +1,474 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+In-process diff tools
+
+These tools compare the texts straight from the trees, using the patience
+diff algorithm from bzrlib, and write the result as text, HTML or JSON.
+Nothing is extracted to a temporary directory, and no process is started,
+so they suit headless use (e.g. continuous integration, or review bots), and
+reports on very large changes, which are streamed to a single file.
+
+They are registered like the external tools, and set the 'internal'
+capability, which tells the Controller to hand them the trees (see the
+compare method) instead of extracting files for them.  The following
+options are recognized (passed with --diff-options):
+
+   --output=FILE   write to FILE instead of standard output
+   --width=N       the width of the side-by-side text (default 160)
+   --context=N     the number of unchanged lines around each change
+"""
+
+import cgi
+import sys
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+from bzrlib import (
+    errors,
+    osutils,
+    patiencediff,
+    )
+
+from difftool import DiffTool
+from tempdir import iter_texts
+import timings
+
+
+# Number of files whose texts are read from the trees at a time:
+TEXT_BATCH_SIZE = 64
+
+# Number of unchanged lines shown around each change:
+DEFAULT_CONTEXT = 3
+
+# Width of the side-by-side text output:
+DEFAULT_WIDTH = 160
+
+# The start and end of an HTML page, and the row class for each marker:
+HTML_HEADER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>bzr diff</title>
+<style>
+table { border-collapse: collapse; font-family: monospace; width: 100%; }
+td { padding: 0 0.5em; white-space: pre; vertical-align: top; }
+td.lineno { color: #888; text-align: right; width: 1%; }
+tr.hunk td { background: #eef; color: #666; }
+tr.changed td { background: #ffd; }
+tr.removed td { background: #fdd; }
+tr.added td { background: #dfd; }
+</style>
+</head>
+<body>
+"""
+
+HTML_FOOTER = """</body>
+</html>
+"""
+
+HTML_ROW_CLASSES = {' ': 'same', '|': 'changed', '<': 'removed', '>': 'added'}
+
+
+class InternalDiffTool(DiffTool):
+  """
+  Subclass of DiffTool for diff tools that run inside bzr.
+
+  The comparison is a pipeline of generators: the changed texts are read
+  from the trees (a batch at a time), each file is diffed, rendered, and
+  appended to the output, before the next batch is read.  So the memory
+  used does not depend on the number of files, and the first file is in
+  the report before the last one has been read.  By default, each file
+  is rendered as a unified diff; subclasses change the output by
+  overriding begin(), render() and end(), each of which returns (or
+  yields) a sequence of strings.
+  """
+
+  def __init__(self, name, diff_options='', **kwargs):
+    """
+    Initialize an InternalDiffTool object with the name and default options.
+    """
+    if 'interactive' not in kwargs:
+      kwargs['interactive'] = False
+    super(InternalDiffTool, self).__init__(name, diff_options, **kwargs)
+    self.supports('internal', True)
+    return
+
+  def compare(self, old_tree, new_tree, changes):
+    """
+    Diff every changed text between two (locked) trees.
+    """
+    context = self.int_option('context', DEFAULT_CONTEXT)
+    output_file = self.option('output')
+    if output_file:
+      out = open(output_file, 'wb')
+    else:
+      out = sys.stdout
+
+    try:
+      diffs = iter_diffs(iter_changed_texts(old_tree, new_tree, changes),
+                         context)
+      for piece in self.report(diffs):
+        out.writelines(piece)
+        out.flush()
+    finally:
+      if output_file:
+        out.close()
+
+    return 1
+
+  def report(self, diffs):
+    """
+    Yield the output in pieces: the start, each file in turn, and the end.
+    """
+    yield self.begin()
+    for (entry, old_lines, new_lines, groups) in diffs:
+      yield self.render(entry, old_lines, new_lines, groups)
+    yield self.end()
+    return
+
+  def option(self, name, default=None):
+    """
+    Return the value of a '--name=value' option, or default if not given.
+    """
+    value = default
+    for arg in self.options.split():
+      if arg.startswith('--%s=' % name):
+        value = arg.split('=', 1)[1]
+
+    return value
+
+  def int_option(self, name, default):
+    """
+    Return the value of a '--name=N' option, as an integer.
+    """
+    value = self.option(name, default)
+    try:
+      return int(value)
+    except ValueError:
+      raise errors.BzrCommandError(
+          "Invalid value for --%s: %r" % (name, value))
+
+  def begin(self):
+    """
+    Return the output needed before the first file.
+    """
+    return []
+
+  def render(self, entry, old_lines, new_lines, groups):
+    """
+    Yield the output for one file (groups is None for binary files).
+    """
+    yield "=== %s file '%s'\n" % (entry.change, display_path(entry))
+    if groups is None:
+      yield 'Binary files differ\n'
+      return
+
+    for group in groups:
+      yield '%s\n' % hunk_header(group)
+      for (tag, i1, i2, j1, j2) in group:
+        if tag == 'equal':
+          for line in old_lines[i1:i2]:
+            yield unified_line(' ', line)
+        else:
+          for line in old_lines[i1:i2]:
+            yield unified_line('-', line)
+          for line in new_lines[j1:j2]:
+            yield unified_line('+', line)
+    yield '\n'
+    return
+
+  def end(self):
+    """
+    Return the output needed after the last file.
+    """
+    return []
+
+  # End class InternalDiffTool
+
+
+class SideBySideDiffTool(InternalDiffTool):
+  """
+  Subclass of InternalDiffTool for side-by-side text, like 'diff -y'.
+  """
+
+  def begin(self):
+    """
+    Work out the column widths, from the options.
+    """
+    self.column = (self.int_option('width', DEFAULT_WIDTH) - 3) // 2
+    return []
+
+  def render(self, entry, old_lines, new_lines, groups):
+    """
+    Yield each group of changes as two columns, with a marker between.
+    """
+    yield "=== %s file '%s'\n" % (entry.change, display_path(entry))
+    if groups is None:
+      yield 'Binary files differ\n'
+      return
+
+    for group in groups:
+      yield '%s\n' % hunk_header(group)
+      for (old_line, marker, new_line) in side_by_side(old_lines, new_lines,
+                                                       group):
+        yield '%-*s %s %s\n' % (self.column, self._clip(old_line), marker,
+                                self._clip(new_line))
+    yield '\n'
+    return
+
+  # Private Methods:
+
+  def _clip(self, line):
+    """
+    Fit a line into one column.
+    """
+    if line is None:
+      return ''
+    return line.rstrip('\r\n').expandtabs()[:self.column]
+
+  # End class SideBySideDiffTool
+
+
+class HtmlDiffTool(InternalDiffTool):
+  """
+  Subclass of InternalDiffTool for a side-by-side HTML page.
+  """
+
+  def begin(self):
+    """
+    Return the start of the page.
+    """
+    return [HTML_HEADER]
+
+  def render(self, entry, old_lines, new_lines, groups):
+    """
+    Yield a table for one file, with a row per line of each change.
+    """
+    yield '<h2>%s %s</h2>\n' % (cgi.escape(entry.change),
+                                 cgi.escape(display_path(entry)))
+    if groups is None:
+      yield '<p>Binary files differ</p>\n'
+      return
+
+    yield '<table>\n'
+    for group in groups:
+      yield ('<tr class="hunk"><td colspan="4">%s</td></tr>\n' %
+             hunk_header(group))
+      # The last line number written on each side:
+      numbers = [group[0][1], group[0][3]]
+      for (old_line, marker, new_line) in side_by_side(old_lines, new_lines,
+                                                       group):
+        cells = []
+        for (side, line) in enumerate((old_line, new_line)):
+          if line is None:
+            cells.append('<td></td><td></td>')
+          else:
+            numbers[side] += 1
+            cells.append('<td class="lineno">%d</td><td>%s</td>' %
+                         (numbers[side], cgi.escape(line.rstrip('\r\n'))))
+        yield '<tr class="%s">%s</tr>\n' % (HTML_ROW_CLASSES[marker],
+                                            ''.join(cells))
+    yield '</table>\n'
+    return
+
+  def end(self):
+    """
+    Return the end of the page.
+    """
+    return [HTML_FOOTER]
+
+  # End class HtmlDiffTool
+
+
+class JsonReportTool(InternalDiffTool):
+  """
+  Subclass of InternalDiffTool for a JSON report, for other programs.
+
+  The report is an object with a 'files' list, holding an object for
+  each changed file (its paths, the kind of change, and its hunks, each
+  with a list of [marker, old_line, new_line] rows, as in side_by_side).
+  The list is written one file at a time, so it is never held in memory.
+  Texts are decoded as UTF-8, replacing any invalid bytes.
+  """
+
+  def begin(self):
+    """
+    Return the start of the report.
+    """
+    self.separator = ''
+    return ['{"files": [\n']
+
+  def render(self, entry, old_lines, new_lines, groups):
+    """
+    Return one file of the report, as a JSON object.
+    """
+    record = {
+        'change': entry.change,
+        'kind': entry.kind,
+        'old_path': entry.old_path,
+        'new_path': entry.new_path,
+        'binary': groups is None,
+        'hunks': [],
+        }
+    for group in groups or []:
+      record['hunks'].append({
+          'header': hunk_header(group),
+          'rows': [[marker, json_text(old_line), json_text(new_line)]
+              for (old_line, marker, new_line) in
+                  side_by_side(old_lines, new_lines, group)],
+          })
+    text = self.separator + json.dumps(record, sort_keys=True)
+    self.separator = ',\n'
+    return [text]
+
+  def end(self):
+    """
+    Return the end of the report.
+    """
+    return ['\n]}\n']
+
+  # End class JsonReportTool
+
+
+# Functions:
+
+def iter_changed_texts(old_tree, new_tree, changes,
+                       batch_size=TEXT_BATCH_SIZE):
+  """
+  Yield (entry, old_lines, new_lines) for each text change, in path order.
+
+  The texts are read a batch at a time, with one bulk request to each
+  tree (see tempdir.iter_texts).  The missing side of an added or
+  removed file, and the old side of a kind change, is empty.
+  """
+  entries = changes.text_changes()
+  for start in range(0, len(entries), batch_size):
+    batch = entries[start:start + batch_size]
+    old_texts = read_lines(old_tree, [(entry.file_id, i)
+        for (i, entry) in enumerate(batch)
+        if entry.change not in ('added', 'kind changed')])
+    new_texts = read_lines(new_tree, [(entry.file_id, i)
+        for (i, entry) in enumerate(batch)
+        if entry.change != 'removed'])
+    for (i, entry) in enumerate(batch):
+      yield (entry, old_texts.get(i, []), new_texts.get(i, []))
+
+  return
+
+
+def iter_diffs(texts, context=DEFAULT_CONTEXT):
+  """
+  Yield (entry, old_lines, new_lines, groups) for each changed text.
+
+  The texts are (entry, old_lines, new_lines) tuples, as generated by
+  iter_changed_texts, and the groups are the grouped opcodes of the diff
+  (or None, if either side is binary).
+  """
+  for (entry, old_lines, new_lines) in texts:
+    if is_binary(old_lines) or is_binary(new_lines):
+      groups = None
+    else:
+      groups = diff_groups(old_lines, new_lines, context)
+    timings.count('files_compared')
+    yield (entry, old_lines, new_lines, groups)
+
+  return
+
+
+def read_lines(tree, desired_files):
+  """
+  Read the texts of (file_id, identifier) files, as {identifier: lines}.
+  """
+  texts = {}
+  for (identifier, chunks) in iter_texts(tree, desired_files):
+    texts[identifier] = osutils.split_lines(''.join(chunks))
+
+  return texts
+
+
+def diff_groups(old_lines, new_lines, context=DEFAULT_CONTEXT):
+  """
+  Return the groups of opcodes for the changes, with some context.
+  """
+  matcher = patiencediff.PatienceSequenceMatcher(None, old_lines, new_lines)
+  return list(matcher.get_grouped_opcodes(context))
+
+
+def side_by_side(old_lines, new_lines, group):
+  """
+  Yield (old_line, marker, new_line) rows for a group of opcodes.
+
+  The marker is ' ' for unchanged lines, '|' for changed lines, '<' for
+  removed lines and '>' for added lines; the missing line is None.
+  """
+  for (tag, i1, i2, j1, j2) in group:
+    if tag == 'equal':
+      for i in range(i2 - i1):
+        yield (old_lines[i1 + i], ' ', new_lines[j1 + i])
+    else:
+      for i in range(max(i2 - i1, j2 - j1)):
+        old_line = None
+        new_line = None
+        if i1 + i < i2:
+          old_line = old_lines[i1 + i]
+        if j1 + i < j2:
+          new_line = new_lines[j1 + i]
+        if new_line is None:
+          yield (old_line, '<', None)
+        elif old_line is None:
+          yield (None, '>', new_line)
+        else:
+          yield (old_line, '|', new_line)
+
+  return
+
+
+def hunk_header(group):
+  """
+  Return a unified diff style '@@' line, for a group of opcodes.
+  """
+  (i1, j1) = (group[0][1], group[0][3])
+  (i2, j2) = (group[-1][2], group[-1][4])
+  return '@@ -%d,%d +%d,%d @@' % (i1 + 1, i2 - i1, j1 + 1, j2 - j1)
+
+
+def unified_line(prefix, line):
+  """
+  Return a line of a unified diff, marking a missing final line ending.
+  """
+  if line.endswith('\n'):
+    return prefix + line
+  return '%s%s\n\\ No newline at end of file\n' % (prefix, line)
+
+
+def display_path(entry):
+  """
+  Return the path to show for a changed entry (both paths for a rename).
+  """
+  if entry.old_path and entry.new_path and entry.old_path != entry.new_path:
+    return '%s => %s' % (entry.old_path, entry.new_path)
+  return entry.new_path or entry.old_path
+
+
+def json_text(line):
+  """
+  Convert a line (or None) for JSON output, without its line ending.
+  """
+  if line is None:
+    return None
+  return line.rstrip('\r\n').decode('utf-8', 'replace')
+
+
+def is_binary(lines):
+  """
+  Check if a text looks binary, the same way as bzrlib.textfile.
+  """
+  return '\x00' in ''.join(lines[:1024])[:1024]
+
+# The End.
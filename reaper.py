@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Background removal of temporary directories
+
+Removing an extracted tree can take a while, and the user should not have
+to wait for it after closing the diff tool.  Instead, discard() just
+renames a temporary directory into a trash directory next to it (which
+is quick, since it stays on the same filesystem), and a detached reaper
+process is started when bzr exits to delete the trash.
+
+The temporary directory is usually shared with other users, so each user
+has their own trash directory, which is only used if it is a real
+directory (not a symlink), owned by the user, and private (mode 0700);
+otherwise the directory is deleted right away.  The reaper's lock is kept
+inside the trash directory, so nobody else can hold it.
+
+The reaper also collects orphaned 'bzr_diff-*_tmp' directories, left
+behind by crashes, once they are older than ORPHAN_AGE.  Directories that
+a tool still uses after bzr exits (e.g. a diff sent to a running server,
+or opendiff) are passed to discard_later() instead, which leaves them
+where they are, to be collected in the same way.
+
+This module is also the reaper's main program, so it must not import
+bzrlib; it only needs to start quickly and delete files.
+"""
+
+import atexit
+import errno
+import getpass
+import glob
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+
+TRASH_NAME = 'bzr_diff-trash'
+LOCK_NAME = '.lock'
+ORPHAN_PATTERN = 'bzr_diff-*_tmp'
+
+# Orphaned temporary directories older than this (in seconds) are removed:
+ORPHAN_AGE = 24 * 3600
+
+# A reaper lock older than this (in seconds) was left by a dead reaper:
+STALE_LOCK_AGE = 3600
+
+# The parent directories whose trash should be reaped when we exit:
+_pending = []
+
+
+def discard(path):
+  """
+  Move a directory to the trash, to be deleted by the background reaper.
+
+  If the directory cannot be moved, or no reaper can be started from
+  this process, it is deleted right away instead.
+  """
+  parent = os.path.dirname(path)
+  trash = make_trash_dir(parent)
+  if not trash:
+    remove_tree(path)
+    return
+
+  try:
+    os.rename(path, os.path.join(trash, os.path.basename(path)))
+  except OSError:
+    remove_tree(path)
+    return
+
+  schedule_reaper(parent)
+  return
+
+
+def discard_later(path):
+  """
+  Leave a directory for a tool that outlives us, to be deleted later.
+
+  The directory stays where it is, since the tool may not have opened
+  its files yet.  It is collected as an orphan once it is ORPHAN_AGE old,
+  by the reaper started when this (or any later) bzr process exits.
+  """
+  parent = os.path.dirname(path)
+  if make_trash_dir(parent):
+    schedule_reaper(parent)
+  return
+
+
+def make_trash_dir(parent):
+  """
+  Create this user's trash directory in parent, if necessary.
+
+  Return its path, or None if it cannot be trusted, or no reaper can be
+  started from this process to empty it.
+  """
+  if not can_spawn():
+    return None
+  trash = trash_dir(parent)
+  try:
+    os.mkdir(trash, 0700)
+    # In case the umask took away some of our own permissions:
+    os.chmod(trash, 0700)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      return None
+  if not is_private_dir(trash):
+    return None
+
+  return trash
+
+
+def schedule_reaper(parent):
+  """
+  Start a reaper for parent when we exit (only one for each directory).
+  """
+  if not _pending:
+    atexit.register(start_reapers)
+  if parent not in _pending:
+    _pending.append(parent)
+  return
+
+
+def trash_dir(parent):
+  """
+  Return the path of this user's trash directory in parent.
+  """
+  if hasattr(os, 'getuid'):
+    user = str(os.getuid())
+  else:
+    user = getpass.getuser()
+  return os.path.join(parent, '%s-%s' % (TRASH_NAME, user))
+
+
+def is_private_dir(path, check_mode=True):
+  """
+  Check that a path is a real directory, owned by us, and only open to us.
+
+  Symlinks are not followed, so a directory planted (or linked) by another
+  user is never trusted.  Without user ids (e.g. on Windows), only the
+  kind of the path is checked.
+  """
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return False
+  if not stat.S_ISDIR(st.st_mode):
+    return False
+  if hasattr(os, 'getuid'):
+    if st.st_uid != os.getuid():
+      return False
+    if check_mode and stat.S_IMODE(st.st_mode) != 0700:
+      return False
+
+  return True
+
+
+def can_spawn():
+  """
+  Check if this process can start a reaper (using the same interpreter).
+  """
+  # A frozen executable (e.g. bzr.exe) cannot run this script:
+  return not getattr(sys, 'frozen', False)
+
+
+def start_reapers():
+  """
+  Start a detached reaper process for each directory with pending trash.
+  """
+  for parent in _pending:
+    try:
+      start_reaper(parent)
+    except (OSError, IOError):
+      # Do the work ourselves, rather than leave it undone:
+      reap(parent)
+  del _pending[:]
+  return
+
+
+def start_reaper(parent):
+  """
+  Start a reaper process for one directory, and do not wait for it.
+  """
+  devnull = open(os.devnull, 'r+b')
+  kwargs = {'stdin': devnull, 'stdout': devnull, 'stderr': devnull}
+  if sys.platform == 'win32':
+    # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP:
+    kwargs['creationflags'] = 0x00000008 | 0x00000200
+  else:
+    kwargs['close_fds'] = True
+    kwargs['preexec_fn'] = os.setsid
+  subprocess.Popen([sys.executable, os.path.abspath(__file__), parent],
+                   **kwargs)
+  devnull.close()
+  return
+
+
+def reap(parent):
+  """
+  Delete the trash, and any old orphaned temporary directories, in parent.
+
+  Only one reaper works on a directory at a time; if another one holds
+  the lock, it will take care of everything.  Only our own (private)
+  trash, and orphans that are real directories owned by us, are removed.
+  """
+  trash = trash_dir(parent)
+  if not is_private_dir(trash):
+    return
+  lock = os.path.join(trash, LOCK_NAME)
+  try:
+    os.mkdir(lock)
+  except OSError:
+    try:
+      if time.time() - os.stat(lock).st_mtime < STALE_LOCK_AGE:
+        return
+      os.rmdir(lock)
+      os.mkdir(lock)
+    except OSError:
+      return
+
+  try:
+    # Keep going until no more trash arrives:
+    names = [name for name in os.listdir(trash) if name != LOCK_NAME]
+    while names:
+      for name in names:
+        remove_tree(os.path.join(trash, name))
+      names = [name for name in os.listdir(trash) if name != LOCK_NAME]
+
+    now = time.time()
+    for path in glob.glob(os.path.join(parent, ORPHAN_PATTERN)):
+      try:
+        if (is_private_dir(path, check_mode=False) and
+            now - os.lstat(path).st_mtime > ORPHAN_AGE):
+          remove_tree(path)
+      except OSError:
+        pass
+  finally:
+    os.rmdir(lock)
+  return
+
+
+def remove_tree(path):
+  """
+  Delete a directory tree, including any read-only files in it.
+  """
+  shutil.rmtree(path, onerror=_make_writable_and_retry)
+  return
+
+
+def _make_writable_and_retry(func, path, exc_info):
+  """
+  Error handler for shutil.rmtree, for read-only files (e.g. on Windows).
+  """
+  try:
+    # Never follow a symlink out of the tree:
+    if not os.path.islink(path):
+      os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+    func(path)
+  except OSError:
+    # Someone else probably removed it first:
+    pass
+  return
+
+
+if __name__ == '__main__':
+  for parent in sys.argv[1:]:
+    reap(parent)
+
+# The End.
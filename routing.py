@@ -0,0 +1,221 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Per-file routing of changed files to other diff tools
+
+Some files are no use in the chosen diff tool: a multi-megabyte generated
+file can hang a GUI tool, and an image or other binary file just wastes
+time loading.  A Router classifies each changed file, before anything is
+extracted, and sends it to another registered tool (see
+ExternalTool.known_tools), or skips it, so it is never written to the
+temporary directories at all.
+
+The routes are set in bazaar.conf, with a tool name or 'skip' for each
+class of file; classes without a route stay with the chosen tool:
+
+    [DEFAULT]
+    difftools_large_tool = skip
+    difftools_large_size = 10485760
+    difftools_binary_tool = skip
+    difftools_image_tool = gimp
+
+The classes are checked in this order, using only cheap tests:
+
+   'image'   the file name has one of the difftools_image_extensions
+             (a comma-separated list, with a default for common formats);
+   'large'   either text is bigger than difftools_large_size bytes (10MB
+             by default), from the inventory, or the file on disk;
+   'binary'  the first few bytes of either text include a NUL byte, as
+             for bzrlib.textfile; only the start of the file is read, from
+             disk in a working tree, or from the repository otherwise.
+"""
+
+import os
+
+from bzrlib import (
+    config,
+    errors,
+    trace,
+    )
+
+
+# A route that leaves the file out of the comparison:
+SKIP = 'skip'
+
+DEFAULT_LARGE_SIZE = 10 * 1024 * 1024
+
+DEFAULT_IMAGE_EXTENSIONS = ('bmp', 'gif', 'ico', 'jpeg', 'jpg', 'png', 'psd',
+                            'tif', 'tiff', 'webp', 'xcf')
+
+# Number of bytes read from the start of a file, to check if it is binary:
+BINARY_CHECK_SIZE = 1024
+
+
+class Router(object):
+  """
+  Classify the changed files of a comparison, and route them to tools.
+  """
+
+  def __init__(self, default_tool, routes, large_size=DEFAULT_LARGE_SIZE,
+               image_extensions=DEFAULT_IMAGE_EXTENSIONS):
+    """
+    Create a router, with a {class: tool name or SKIP} dictionary of routes.
+    """
+    self.default_tool = default_tool
+    self.routes = routes
+    self.large_size = large_size
+    self.image_extensions = image_extensions
+    self.routed = {}
+    return
+
+  @staticmethod
+  def from_config(default_tool):
+    """
+    Return a Router for the routes in bazaar.conf, or None if there are none.
+    """
+    global_config = config.GlobalConfig()
+    routes = {}
+    for file_class in ('image', 'large', 'binary'):
+      tool_name = global_config.get_user_option('difftools_%s_tool' %
+                                                file_class)
+      if tool_name and tool_name != default_tool:
+        routes[file_class] = tool_name
+    if not routes:
+      return None
+
+    large_size = global_config.get_user_option('difftools_large_size')
+    try:
+      if large_size is None:
+        large_size = DEFAULT_LARGE_SIZE
+      else:
+        large_size = int(large_size)
+    except ValueError:
+      raise errors.BzrError(
+          "Invalid value for difftools_large_size: %r" % large_size)
+
+    image_extensions = global_config.get_user_option(
+        'difftools_image_extensions')
+    if image_extensions is None:
+      image_extensions = DEFAULT_IMAGE_EXTENSIONS
+    else:
+      if isinstance(image_extensions, basestring):
+        image_extensions = image_extensions.split(',')
+      image_extensions = [extension.strip().lower()
+          for extension in image_extensions]
+
+    return Router(default_tool, routes, large_size, image_extensions)
+
+  def route(self, changes, old_tree, new_tree):
+    """
+    Classify each text change, and return the changes without skipped files.
+
+    Files for other tools stay in the returned ChangeIndex (they are
+    extracted as usual), and are listed by tool in self.routed.
+    """
+    skipped = []
+    for entry in changes.text_changes():
+      file_class = self.classify(entry, old_tree, new_tree)
+      if file_class is None:
+        continue
+      tool_name = self.routes[file_class]
+      if tool_name == SKIP:
+        skipped.append(entry)
+      else:
+        self.routed.setdefault(tool_name, []).append(entry.file_id)
+
+    if skipped:
+      trace.note('Skipping %d file(s): %s' % (len(skipped),
+          ', '.join([entry.new_path or entry.old_path for entry in skipped])))
+    return changes.skip([entry.file_id for entry in skipped])
+
+  def classify(self, entry, old_tree, new_tree):
+    """
+    Return the class of a changed file with a route, or None.
+    """
+    path = entry.new_path or entry.old_path
+    if 'image' in self.routes:
+      extension = os.path.splitext(path)[1][1:].lower()
+      if extension in self.image_extensions:
+        return 'image'
+
+    if 'large' in self.routes:
+      sizes = []
+      if entry.change not in ('added', 'kind changed'):
+        sizes.append(text_size(old_tree, entry.file_id, entry.old_path))
+      if entry.change != 'removed':
+        sizes.append(text_size(new_tree, entry.file_id, entry.new_path))
+      if max(sizes) > self.large_size:
+        return 'large'
+
+    if 'binary' in self.routes:
+      for (tree, tree_path) in ((new_tree, entry.new_path),
+                                (old_tree, entry.old_path)):
+        if tree_path is None:
+          continue
+        if hasattr(tree, 'abspath'):
+          binary = is_binary_file(tree.abspath(tree_path))
+        else:
+          binary = is_binary_text(tree, entry.file_id)
+        if binary:
+          return 'binary'
+
+    return None
+
+  # End class Router
+
+
+# Functions:
+
+def text_size(tree, file_id, path):
+  """
+  Return the size of a text, from the inventory or the file on disk.
+
+  Return 0 if the size is not known without reading the text.
+  """
+  size = tree.inventory[file_id].text_size
+  if size is None and hasattr(tree, 'abspath'):
+    try:
+      size = os.lstat(tree.abspath(path)).st_size
+    except OSError:
+      pass
+
+  return size or 0
+
+
+def is_binary_file(abs_path):
+  """
+  Check if the start of a file includes a NUL byte.
+  """
+  try:
+    f = open(abs_path, 'rb')
+  except IOError:
+    return False
+  try:
+    head = f.read(BINARY_CHECK_SIZE)
+  finally:
+    f.close()
+
+  return '\x00' in head
+
+
+def is_binary_text(tree, file_id):
+  """
+  Check if the start of a text in a (revision) tree includes a NUL byte.
+
+  Only the first chunks of the text are read, where the tree allows it.
+  """
+  if hasattr(tree, 'iter_files_bytes'):
+    head = ''
+    for (identifier, bytes_iter) in tree.iter_files_bytes([(file_id, None)]):
+      for chunk in bytes_iter:
+        head += chunk
+        if len(head) >= BINARY_CHECK_SIZE:
+          break
+  else:
+    head = tree.get_file(file_id).read(BINARY_CHECK_SIZE)
+
+  return '\x00' in head[:BINARY_CHECK_SIZE]
+
+# The End.
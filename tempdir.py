@@ -6,14 +6,44 @@
 Named temporary directory that cleans up automatically
 """
 
+import itertools
 import os
+import shutil
+import sys
+import threading
+from Queue import Queue
 
 from bzrlib import (
     errors,
-    export,
     osutils,
+    trace,
+    ui,
     )
 
+from reaper import discard, discard_later
+from textcache import get_text_cache
+import timings
+
+
+# Number of threads used to write extracted files:
+EXTRACT_THREADS = 4
+
+# Texts larger than this (in bytes) are written as they are read, instead
+# of being held in memory for a writer thread:
+MAX_QUEUED_TEXT_SIZE = 1024 * 1024
+
+# The Linux ioctl request for cloning a file (reflink):
+FICLONE = 0x40049409
+
+# Number of bytes read at a time, when a tree cannot give us its chunks:
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait for a pipe Feeder to stop, before trying again:
+FEEDER_POLL_INTERVAL = 0.1
+
+# Serializes the repository reads of the pipe Feeders (see Feeder.run):
+_feeder_read_lock = threading.Lock()
+
 
 class NamedTemporaryDir(object):
   """
@@ -29,27 +59,81 @@ class NamedTemporaryDir(object):
     """
     self.path = osutils.mkdtemp(prefix=prefix, suffix=suffix + '_tmp')
     self.readonly = readonly
-    self.cleaned = (not cleanup)
+    self.keep = (not cleanup)
+    self.cleaned = False
+    self.feeders = []
+    self.link_sources = []
+    self.written = {}
+    return
+
+  def add_link_source(self, source):
+    """
+    Add a place to look for texts, before extracting them from the tree.
+
+    The source is either another NamedTemporaryDir, or a working tree.
+    Any file whose SHA-1 matches a file in one of the sources is cloned
+    from there: by a reflink, if the filesystem supports them (e.g. btrfs
+    or XFS), or by a hardlink, if both directories are read-only, or
+    else by a plain copy.  Working tree files are never hardlinked, since
+    the read-only bit would be shared with the working tree.
+    """
+    self.link_sources.append(source)
     return
   
-  def write_stuff(self, rev_tree, file_id_list, use_tree=False):
+  def write_stuff(self, rev_tree, file_id_list, use_tree=False, changes=None,
+                  stream=False):
     """
     Write to either individual files, or a whole tree, based on flag.
+
+    If a ChangeIndex is provided along with use_tree, only the changed
+    portion of the tree is written (see write_changes).  If stream is
+    set, individual files are streamed through named pipes instead of
+    being written (see write_pipes).
     """
-    if use_tree:
+    if stream and not use_tree:
+      self.write_pipes(rev_tree, file_id_list)
+    elif use_tree and changes is not None:
+      self.write_changes(rev_tree, file_id_list, changes)
+    elif use_tree:
       self.write_tree(rev_tree, file_id_list)
     else:
       self.write_files(rev_tree, file_id_list)
     return
 
-  def write_tree(self, rev_tree, file_id_list):
+  def write_tree(self, rev_tree, file_id_list, skipped=()):
     """
     Write the whole revision tree contents to our temporary directory. 
     The directory will be removed when the ScratchArea is deleted.
+
+    Any file_ids in skipped (see ChangeIndex.skip) are left out.
+    """
+    skipped = dict.fromkeys(skipped)
+    entries = [(path, entry.file_id)
+        for (path, entry) in rev_tree.inventory.iter_entries()
+        if entry.file_id not in skipped]
+    self._write_entries(rev_tree, entries)
+
+    return
+
+  def write_changes(self, rev_tree, file_id_list, changes):
+    """
+    Write a sparse copy of the revision tree to our temporary directory.
+
+    Only the entries named in the ChangeIndex (modified, added, removed,
+    renamed and kind changes) are written, at their usual location in the
+    tree, so recursive tools see the same layout as a full export, minus
+    the unchanged files.  The directories in file_id_list are always
+    created, since they may be used as the root of the comparison.
+    Skipped files (see ChangeIndex.skip) are left out.
     """
-    osutils.delete_any(self.path)
-    export.export(rev_tree, self.path, format='dir')
-    self._make_readonly()
+    skipped = dict.fromkeys(changes.skipped)
+    entries = {}
+    for file_id in file_id_list + changes.file_ids():
+      if rev_tree.has_id(file_id) and file_id not in skipped:
+        entries[file_id] = rev_tree.id2path(file_id)
+    self._write_entries(rev_tree,
+                        sorted([(path, file_id)
+                                for (file_id, path) in entries.items()]))
 
     return
 
@@ -58,23 +142,63 @@ class NamedTemporaryDir(object):
     Find the desired revision of each file, write it to our temporary
     directory.  The directory will be removed when the ScratchArea is
     deleted.
+
+    Each file is written at its path in the tree, so files with the same
+    name in different directories do not collide.
     """
-    for file_id in file_id_list:
-      if rev_tree.has_id(file_id):
-        base_name = osutils.basename(rev_tree.id2path(file_id))
-        # write in binary mode, to avoid OS-specific translations:
-        tmp_file = open(osutils.pathjoin(self.path, base_name), 'wb')
-        osutils.pumpfile(rev_tree.get_file(file_id), tmp_file)
-        tmp_file.close()
+    self._extract(rev_tree, self._file_paths(rev_tree, file_id_list))
 
-    self._make_readonly()
+    return
+
+  def write_pipes(self, rev_tree, file_id_list):
+    """
+    Create a named pipe in place of each file, to stream its text through.
+
+    Each text is fed to its pipe by a background Feeder, which reads it
+    from the tree a chunk at a time once the diff tool opens the pipe,
+    so nothing is written to disk, and only one chunk of each text is
+    held in memory.  This only works for tools that read each file once,
+    from start to end.  Without named pipes on this platform, the files
+    are just written as usual.
+    """
+    if not hasattr(os, 'mkfifo'):
+      self.write_files(rev_tree, file_id_list)
+      return
+
+    for (file_id, pipe_path) in self._file_paths(rev_tree, file_id_list):
+      # The owner must be able to open the write end, so not read-only:
+      os.mkfifo(pipe_path, 0600)
+      feeder = Feeder(rev_tree, file_id, pipe_path)
+      feeder.start()
+      self.feeders.append(feeder)
 
     return
 
+  def write_empty(self, path):
+    """
+    Write an empty file at a path in the directory, and return its location.
+
+    This stands in for a file that is missing from one of the trees.
+    """
+    abs_path = osutils.pathjoin(self.path, path)
+    self._make_dirs(osutils.dirname(abs_path))
+    open(abs_path, 'wb').close()
+    if self.readonly:
+      osutils.make_readonly(abs_path)
+
+    return abs_path
+
   def cleanup(self):
     """
     Clean up a temporary directory and all its contents.
+
+    The directory is only moved aside here; it is deleted later by a
+    background reaper (see reaper.py), so nobody has to wait for it.  If
+    the tool does not allow cleanup (it may still be using the files
+    after we exit), the directory is left in place, and the reaper only
+    removes it once it is a day old.
     """
+    self._stop_feeders()
 
     # As a safety precaution, make sure we didn't get a completely bogus path:
     if (not self.path.endswith('_tmp')):
@@ -82,7 +206,12 @@ class NamedTemporaryDir(object):
                             self.path)
     if (not self.cleaned):
       self.cleaned = True
-      osutils.rmtree(self.path)
+      if self.keep:
+        discard_later(self.path)
+      else:
+        timer = timings.start('cleanup')
+        discard(self.path)
+        timings.stop(timer)
     return
     
   def __del__(self):
@@ -92,18 +221,545 @@ class NamedTemporaryDir(object):
     self.cleanup()
 
   # Private Methods:
+
+  def _make_dirs(self, abs_path):
+    """
+    Create a directory (and any missing parents) in the temporary directory.
+    """
+    if not osutils.isdir(abs_path):
+      os.makedirs(abs_path)
+    return
   
-  def _make_readonly(self):
+  def _file_paths(self, rev_tree, file_id_list):
     """
-    Make the contents of the temporary directory read-only.
+    Return (file_id, abs_path) for each file in the tree, making the dirs.
+
+    The parent directories are collected first, and each one is created
+    only once, in order.
+    """
+    files = [(file_id, osutils.pathjoin(self.path, rev_tree.id2path(file_id)))
+        for file_id in file_id_list
+        if rev_tree.has_id(file_id)]
+    parents = {}
+    for (file_id, abs_path) in files:
+      parents[osutils.dirname(abs_path)] = True
+    for parent in sorted(parents.keys()):
+      self._make_dirs(parent)
+
+    return files
+
+  def _write_entries(self, rev_tree, entries):
+    """
+    Write a list of (path, file_id) inventory entries, keeping the layout.
+
+    Directories and symlinks are created here, the files are handed to
+    _extract.
     """
+    inventory = rev_tree.inventory
+    files = []
+    for (path, file_id) in entries:
+      entry = inventory[file_id]
+      abs_path = osutils.pathjoin(self.path, path)
+      if entry.kind == 'directory' or entry.kind == 'root_directory':
+        self._make_dirs(abs_path)
+      elif entry.kind == 'file':
+        self._make_dirs(osutils.dirname(abs_path))
+        files.append((file_id, abs_path))
+      elif entry.kind == 'symlink' and osutils.has_symlinks():
+        self._make_dirs(osutils.dirname(abs_path))
+        os.symlink(entry.symlink_target, abs_path)
+    self._extract(rev_tree, files)
+
+    return
+
+  def _extract(self, rev_tree, files):
+    """
+    Write a list of (file_id, abs_path) files from the revision tree.
+
+    Trees cannot be shared between threads, so the texts are read from
+    the repository in this thread, in one bulk request (see iter_texts),
+    while a small pool of writer threads writes them out (and sets the
+    read-only bit) as they arrive.  A text larger than
+    MAX_QUEUED_TEXT_SIZE is written by this thread as it is read, so only
+    small texts are ever held in memory.  The first failure, in list
+    order, is raised once all writers are done.
+
+    Cached texts are hardlinked, so the text cache is only used for
+    read-only directories; otherwise the diff tool could modify it.
+    Texts that are not cached, but are already on disk in one of the
+    link sources, are cloned from there instead (see add_link_source).
+
+    Progress is reported as the texts arrive (which can take a while
+    from a remote branch).
+    """
+    text_cache = None
     if self.readonly:
-      for (directory, subdirs, files) in os.walk(self.path):
-        for file in files:
-          osutils.make_readonly(osutils.pathjoin(directory, file))
-    
+      text_cache = get_text_cache()
+
+    timer = timings.start('extract_files')
+    wanted = {}
+    for (index, (file_id, abs_path)) in enumerate(files):
+      sha1 = rev_tree.inventory[file_id].text_sha1
+      if sha1:
+        if text_cache and text_cache.link(sha1, abs_path):
+          self.written[sha1] = abs_path
+          timings.count('cache_hits')
+          continue
+        method = self._link_from_sources(file_id, sha1, abs_path)
+        if method == 'copy':
+          timings.count('copied_files')
+          continue
+        if method:
+          timings.count('linked_files')
+          continue
+      wanted[index] = (file_id, sha1, abs_path)
+
+    progress = None
+    if wanted:
+      progress = ui.ui_factory.nested_progress_bar()
+    pool = WriterPool(min(EXTRACT_THREADS, len(wanted)), text_cache,
+                      self.readonly, self.written)
+    try:
+      done = 0
+      for (index, chunks) in iter_text_chunks(rev_tree,
+          [(file_id, index) for (index, (file_id, sha1, abs_path))
+           in sorted(wanted.items())]):
+        (file_id, sha1, abs_path) = wanted[index]
+        (head, rest) = read_head(chunks, MAX_QUEUED_TEXT_SIZE)
+        if rest is None:
+          pool.put(index, head, sha1, abs_path)
+        else:
+          pool.write_now(index, itertools.chain(head, rest), sha1, abs_path)
+        done += 1
+        if progress:
+          progress.update('Extracting files', done, len(wanted))
+    finally:
+      pool.close()
+      if progress:
+        progress.finished()
+    pool.raise_error()
+    timings.stop(timer, files_extracted=len(files))
+
+    self._evict_cache()
+
+    return
+
+  def _stop_feeders(self):
+    """
+    Stop any pipe feeders that are still waiting for the tool to read.
+    """
+    for feeder in self.feeders:
+      feeder.stop()
+    self.feeders = []
+    return
+
+  def _link_from_sources(self, file_id, sha1, abs_path):
+    """
+    Clone a text from one of the link sources.
+
+    Return how it was cloned (see clone_file), or None if it was not.
+    """
+    for source in self.link_sources:
+      if isinstance(source, NamedTemporaryDir):
+        src_path = source.written.get(sha1)
+        # Both sides must be read-only, if they are to share an inode:
+        allow_hardlink = self.readonly and source.readonly
+      elif source.has_id(file_id) and source.get_file_sha1(file_id) == sha1:
+        src_path = source.id2abspath(file_id)
+        allow_hardlink = False
+      else:
+        src_path = None
+      method = None
+      if src_path:
+        method = clone_file(src_path, abs_path, allow_hardlink)
+      if method:
+        if self.readonly:
+          osutils.make_readonly(abs_path)
+        self.written[sha1] = abs_path
+        return method
+
+    return None
+
+  def _evict_cache(self):
+    """
+    Keep the text cache within its size limit, after adding new texts.
+    """
+    text_cache = get_text_cache()
+    if text_cache and text_cache.added:
+      text_cache.evict()
     return
 
   # End class NamedTemporaryDir
-  
+
+
+class WriterPool(object):
+  """
+  A bounded pool of threads that write file texts to disk.
+
+  Texts are queued with put(), and written by the next free thread.  The
+  queue is bounded, so the reader cannot get too far ahead of the
+  writers (and hold too many texts in memory); large texts should not be
+  queued at all, but streamed with write_now().  Errors are recorded with
+  the index of the failing file, and re-raised by raise_error().
+  """
+
+  def __init__(self, num_threads, text_cache=None, readonly=True,
+               written=None):
+    """
+    Start the writer threads (none, if num_threads is less than 2).
+
+    If a 'written' dictionary is given, the path of each text with a
+    known SHA-1 is recorded in it, as {sha1: abs_path}.
+    """
+    self.text_cache = text_cache
+    self.readonly = readonly
+    self.written = written
+    self.errors = []
+    self.queue = Queue(2 * num_threads)
+    self.threads = []
+    if num_threads > 1:
+      for i in range(num_threads):
+        thread = threading.Thread(target=self._work)
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+    return
+
+  def put(self, index, chunks, sha1, abs_path):
+    """
+    Queue a text (a list of chunks) to be written, or write it now if
+    there are no threads.
+    """
+    if self.threads:
+      self.queue.put((index, chunks, sha1, abs_path))
+    else:
+      self._write(index, chunks, sha1, abs_path)
+    return
+
+  def write_now(self, index, chunks, sha1, abs_path):
+    """
+    Write a text in this thread, as its chunks are read from an iterator.
+
+    The text cache is not used, since it may read some of the chunks
+    before it gives up, and they cannot be read again.
+    """
+    self._write(index, chunks, sha1, abs_path, use_cache=False)
+    # After an error, the rest must still be read, before the next text:
+    for chunk in chunks:
+      pass
+    return
+
+  def close(self):
+    """
+    Wait for all queued texts to be written, and stop the threads.
+    """
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+    return
+
+  def raise_error(self):
+    """
+    Re-raise the error for the first failing file, if there was one.
+    """
+    if self.errors:
+      self.errors.sort()
+      (index, exc_info) = self.errors[0]
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return
+
+  # Private Methods:
+
+  def _work(self):
+    """
+    Write queued texts until told to stop.
+    """
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      self._write(*job)
+    return
+
+  def _write(self, index, chunks, sha1, abs_path, use_cache=True):
+    """
+    Write one text to disk, recording any error.
+    """
+    try:
+      if (use_cache and sha1 and self.text_cache and
+          self.text_cache.add(sha1, chunks, abs_path)):
+        size = sum([len(chunk) for chunk in chunks])
+      else:
+        size = 0
+        # write in binary mode, to avoid OS-specific translations:
+        tmp_file = open(abs_path, 'wb')
+        try:
+          for chunk in chunks:
+            tmp_file.write(chunk)
+            size += len(chunk)
+        finally:
+          tmp_file.close()
+        if self.readonly:
+          osutils.make_readonly(abs_path)
+      if sha1 and self.written is not None:
+        self.written[sha1] = abs_path
+      timings.count('bytes_written', size)
+    except:
+      self.errors.append((index, sys.exc_info()))
+    return
+
+  # End class WriterPool
+
+
+class Feeder(threading.Thread):
+  """
+  A background thread that streams one text from a tree into a named pipe.
+
+  The feeder holds its own read lock on the tree until it is done.  It
+  blocks until the diff tool opens the pipe, which is after all the
+  extraction is finished, and the session's locks are released; even so,
+  several feeders may share a repository, so their reads are serialized
+  (but not their writes, since the tool may read the pipes in any order).
+  """
+
+  def __init__(self, rev_tree, file_id, pipe_path):
+    """
+    Prepare to feed the text of file_id to the pipe at pipe_path.
+    """
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.rev_tree = rev_tree
+    self.file_id = file_id
+    self.pipe_path = pipe_path
+    self.stopped = False
+    rev_tree.lock_read()
+    return
+
+  def run(self):
+    """
+    Open the pipe (once the tool opens it too), and write the text to it.
+    """
+    try:
+      try:
+        # unbuffered, so close() cannot fail on a broken pipe:
+        pipe = open(self.pipe_path, 'wb', 0)
+      except (IOError, OSError), e:
+        trace.warning('Cannot stream %s: %s' % (self.pipe_path, e))
+        # Give the tool an empty file, rather than leave it blocked, whether
+        # it already opened the pipe or not:
+        unblock_pipe(self.pipe_path, os.O_WRONLY)
+        try:
+          osutils.delete_any(self.pipe_path)
+          open(self.pipe_path, 'wb').close()
+        except (IOError, OSError):
+          pass
+        return
+      try:
+        self._feed(pipe)
+      finally:
+        pipe.close()
+    finally:
+      self.rev_tree.unlock()
+    return
+
+  def stop(self):
+    """
+    Stop feeding, and wait for the thread.
+
+    The thread may be blocked opening the pipe (if the tool never opened
+    it), or writing to it (if the tool stopped reading), so the pipe is
+    opened, and drained, until the thread notices it was stopped.
+    """
+    self.stopped = True
+    while self.isAlive():
+      unblock_pipe(self.pipe_path, os.O_RDONLY)
+      self.join(FEEDER_POLL_INTERVAL)
+    return
+
+  # Private Methods:
+
+  def _feed(self, pipe):
+    """
+    Write the chunks of the text to the pipe, as they are read.
+    """
+    chunks = iter_file_chunks(self.rev_tree, self.file_id)
+    while not self.stopped:
+      _feeder_read_lock.acquire()
+      try:
+        try:
+          chunk = chunks.next()
+        except StopIteration:
+          break
+        except Exception, e:
+          trace.warning('Cannot read the text of %s: %s' %
+                        (self.pipe_path, e))
+          break
+      finally:
+        _feeder_read_lock.release()
+      try:
+        pipe.write(chunk)
+      except (IOError, OSError), e:
+        if not self.stopped:
+          trace.mutter('Stopped streaming %s: %s' % (self.pipe_path, e))
+        break
+    return
+
+  # End class Feeder
+
+
+# Functions:
+
+def clone_file(src_path, dest_path, allow_hardlink=False):
+  """
+  Make dest_path a copy of src_path, as cheaply as possible.
+
+  Try a reflink (a copy-on-write clone, sharing the data blocks), then a
+  hardlink if allowed, and finally fall back to copying the bytes.
+  Return which of these worked ('reflink', 'hardlink' or 'copy'), or
+  None if the source could not be read.
+  """
+  if reflink(src_path, dest_path):
+    return 'reflink'
+  if allow_hardlink and hasattr(os, 'link'):
+    try:
+      os.link(src_path, dest_path)
+      return 'hardlink'
+    except OSError:
+      pass
+  try:
+    shutil.copyfile(src_path, dest_path)
+  except (IOError, OSError):
+    if osutils.lexists(dest_path):
+      osutils.delete_any(dest_path)
+    return None
+
+  return 'copy'
+
+
+def reflink(src_path, dest_path):
+  """
+  Clone a file with the Linux FICLONE ioctl, return True if it worked.
+  """
+  if not sys.platform.startswith('linux'):
+    return False
+  import fcntl
+
+  try:
+    src_file = open(src_path, 'rb')
+  except IOError:
+    return False
+  try:
+    dest_file = open(dest_path, 'wb')
+    try:
+      fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+      cloned = True
+    except IOError:
+      # Not supported by this filesystem (or not the same filesystem):
+      cloned = False
+    dest_file.close()
+  finally:
+    src_file.close()
+  if not cloned:
+    os.remove(dest_path)
+
+  return cloned
+
+
+def iter_texts(rev_tree, desired_files):
+  """
+  Yield (identifier, chunks) for each (file_id, identifier) desired.
+
+  Each text is read into memory, as a list of chunks; see
+  iter_text_chunks for the order, and for reading large texts.
+  """
+  for (identifier, chunks) in iter_text_chunks(rev_tree, desired_files):
+    yield (identifier, list(chunks))
+
+
+def iter_text_chunks(rev_tree, desired_files):
+  """
+  Yield (identifier, chunk_iterator) for each (file_id, identifier) desired.
+
+  Where the tree supports it, all the texts are requested at once with
+  iter_files_bytes, so the repository can read them in as few (mostly
+  sequential) reads as possible, or a remote repository can coalesce
+  them into a few pipelined readv requests on one connection, instead
+  of a round trip per file; they arrive in no particular order.
+  Otherwise, each file is read in turn.  Each iterator must be used up
+  before the next text is read.
+  """
+  if not desired_files:
+    return
+  if hasattr(rev_tree, 'iter_files_bytes'):
+    for (identifier, bytes_iter) in rev_tree.iter_files_bytes(desired_files):
+      yield (identifier, bytes_iter)
+  else:
+    for (file_id, identifier) in desired_files:
+      yield (identifier, iter_file_reads(rev_tree.get_file(file_id)))
+
+
+def iter_file_chunks(rev_tree, file_id):
+  """
+  Yield the text of one file from a tree, a chunk at a time.
+  """
+  for (identifier, chunks) in iter_text_chunks(rev_tree, [(file_id, None)]):
+    for chunk in chunks:
+      yield chunk
+
+
+def iter_file_reads(text_file):
+  """
+  Yield the contents of a file object, STREAM_CHUNK_SIZE bytes at a time.
+  """
+  chunk = text_file.read(STREAM_CHUNK_SIZE)
+  while chunk:
+    yield chunk
+    chunk = text_file.read(STREAM_CHUNK_SIZE)
+
+
+def read_head(chunks, max_size):
+  """
+  Read chunks from an iterator, until more than max_size bytes are read.
+
+  Return (head, rest): the list of chunks read, and the iterator for the
+  rest of them, or None if it was used up within max_size bytes.
+  """
+  chunks = iter(chunks)
+  head = []
+  size = 0
+  for chunk in chunks:
+    head.append(chunk)
+    size += len(chunk)
+    if size > max_size:
+      return (head, chunks)
+
+  return (head, None)
+
+
+def unblock_pipe(pipe_path, flags):
+  """
+  Open and close the other end of a named pipe, without blocking.
+
+  Opening the write end (os.O_WRONLY) lets a blocked reader see an empty
+  file; opening the read end (os.O_RDONLY) lets a blocked writer open it,
+  and draining it lets a blocked write go through.  Errors are ignored,
+  since nobody may be waiting at the other end.
+  """
+  try:
+    fd = os.open(pipe_path, flags | os.O_NONBLOCK)
+  except OSError:
+    return
+  try:
+    if flags == os.O_RDONLY:
+      try:
+        os.read(fd, STREAM_CHUNK_SIZE)
+      except OSError:
+        pass
+  finally:
+    os.close(fd)
+  return
+
+
 # The End.
@@ -0,0 +1,264 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Persistent, content-addressed cache of extracted file texts
+
+Extracting the old revision of a file from the repository is repeated on
+every 'bzr diff --using' run, even when the same revision was extracted
+a few seconds earlier.  This module keeps a copy of each extracted text
+in the bzr configuration directory, keyed by the SHA-1 recorded in the
+inventory, so later runs can hardlink the cached copy into their
+temporary directory instead of reading the repository again.
+
+The cache is shared between concurrent bzr processes:
+
+   * new entries are written to a private temporary file and renamed
+     into place, so a reader never sees a partially written text;
+   * entries are read-only, and are only ever linked into read-only
+     temporary directories, so a diff tool cannot corrupt the cache;
+   * eviction is serialized with a lock directory, and every other
+     operation tolerates an entry disappearing underneath it.
+
+The total size is bounded by the 'difftools_cache_size' option in
+bazaar.conf (in bytes, default 256MB); the least recently used entries
+are evicted first.  Setting the size to 0 disables the cache.
+
+Hardlinks cannot cross filesystems, so the cache is also disabled when
+the configuration directory is not on the same filesystem as the
+temporary directories (e.g. when /tmp is a tmpfs).
+"""
+
+import os
+import tempfile
+import thread
+import time
+
+from bzrlib import (
+    config,
+    errors,
+    osutils,
+    trace,
+    )
+
+try:
+  from hashlib import sha1 as new_sha
+except ImportError:
+  from sha import new as new_sha
+
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Eviction locks older than this (in seconds) were left by a dead process:
+STALE_LOCK_AGE = 3600
+
+
+class TextCache(object):
+  """
+  A size-bounded, least recently used store of file texts, keyed by SHA-1.
+  """
+
+  def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+    """
+    Open (or create) a text cache in the given directory.
+    """
+    self.path = path
+    self.max_size = max_size
+    self.added = 0
+    # Texts are added by several writer threads at once:
+    self._added_lock = thread.allocate_lock()
+    return
+
+  def link(self, sha1, dest_path):
+    """
+    Hardlink a cached text to dest_path, return True if it was found.
+    """
+    entry_path = self._entry_path(sha1)
+    try:
+      os.link(entry_path, dest_path)
+    except OSError:
+      return False
+
+    # Record the use, for the LRU eviction:
+    try:
+      os.utime(entry_path, None)
+    except OSError:
+      pass
+    return True
+
+  def add(self, sha1, chunks, dest_path):
+    """
+    Store a text in the cache, and hardlink it to dest_path.
+
+    The text is only kept if its SHA-1 matches the key, since other
+    processes will trust the key without checking the contents.  Return
+    False if the text could not be cached (dest_path is not written).
+    """
+    entry_path = self._entry_path(sha1)
+    entry_dir = osutils.dirname(entry_path)
+    tmp_path = '%s.%d.%d.tmp' % (entry_path, os.getpid(), thread.get_ident())
+    try:
+      if not osutils.isdir(entry_dir):
+        try:
+          os.makedirs(entry_dir)
+        except OSError:
+          if not osutils.isdir(entry_dir):
+            raise
+
+      # write in binary mode, to avoid OS-specific translations:
+      tmp_file = open(tmp_path, 'wb')
+      try:
+        digest = new_sha()
+        size = 0
+        for chunk in chunks:
+          digest.update(chunk)
+          size += len(chunk)
+          tmp_file.write(chunk)
+      finally:
+        tmp_file.close()
+      if digest.hexdigest() != sha1:
+        self._remove_quietly(tmp_path)
+        return False
+      osutils.make_readonly(tmp_path)
+    except (IOError, OSError):
+      # A broken cache directory must not stop the diff, so do without it:
+      self._remove_quietly(tmp_path)
+      return False
+
+    try:
+      os.rename(tmp_path, entry_path)
+    except OSError:
+      # Probably a concurrent add of the same text, which is just as good:
+      osutils.delete_any(tmp_path)
+    self._added_lock.acquire()
+    try:
+      self.added += size
+    finally:
+      self._added_lock.release()
+
+    return self.link(sha1, dest_path)
+
+  def evict(self):
+    """
+    Remove the least recently used entries, until the cache fits its size.
+
+    Only one process evicts at a time; if another process already holds
+    the lock, just leave the work to that process.
+    """
+    lock_path = osutils.pathjoin(self.path, 'evict.lock')
+    try:
+      os.mkdir(lock_path)
+    except OSError:
+      try:
+        if time.time() - os.stat(lock_path).st_mtime < STALE_LOCK_AGE:
+          return
+        os.rmdir(lock_path)
+        os.mkdir(lock_path)
+      except OSError:
+        return
+
+    try:
+      entries = []
+      total = 0
+      for (directory, subdirs, files) in os.walk(self.path):
+        for name in files:
+          if name.endswith('.tmp'):
+            continue
+          entry_path = osutils.pathjoin(directory, name)
+          try:
+            st = os.stat(entry_path)
+          except OSError:
+            continue
+          entries.append((st.st_mtime, st.st_size, entry_path))
+          total += st.st_size
+
+      entries.sort()
+      for (mtime, size, entry_path) in entries:
+        if total <= self.max_size:
+          break
+        try:
+          # Do not chmod first, other temporary directories may share it:
+          os.remove(entry_path)
+          total -= size
+        except OSError:
+          pass
+    finally:
+      os.rmdir(lock_path)
+
+    self.added = 0
+    return
+
+  # Private Methods:
+
+  def _entry_path(self, sha1):
+    """
+    Return the location of the cache entry for this SHA-1.
+    """
+    return osutils.pathjoin(self.path, sha1[:2], sha1[2:])
+
+  def _remove_quietly(self, tmp_path):
+    """
+    Remove a partly written entry, if there is one.
+    """
+    try:
+      osutils.delete_any(tmp_path)
+    except (IOError, OSError):
+      pass
+    return
+
+  # End class TextCache
+
+
+# Functions:
+
+_text_cache = None
+
+def get_text_cache():
+  """
+  Return the shared TextCache for this process, or None if it is disabled.
+  """
+  global _text_cache
+  if _text_cache is None:
+    if not hasattr(os, 'link'):
+      _text_cache = False
+    else:
+      max_size = config.GlobalConfig().get_user_option('difftools_cache_size')
+      try:
+        if max_size is None:
+          max_size = DEFAULT_MAX_SIZE
+        else:
+          max_size = int(max_size)
+      except ValueError:
+        raise errors.BzrError(
+            "Invalid value for difftools_cache_size: %r" % max_size)
+      if max_size > 0:
+        cache_path = osutils.pathjoin(config.config_dir(), 'difftools',
+                                      'cache')
+        tmp_path = tempfile.gettempdir()
+        if device_of(cache_path) == device_of(tmp_path):
+          _text_cache = TextCache(cache_path, max_size)
+        else:
+          trace.mutter('difftools text cache disabled: %s and %s are on'
+                       ' different filesystems' % (cache_path, tmp_path))
+          _text_cache = False
+      else:
+        _text_cache = False
+
+  return _text_cache or None
+
+
+def device_of(path):
+  """
+  Return the device of a path, or of its nearest existing parent.
+  """
+  path = osutils.abspath(path)
+  while not os.path.exists(path):
+    parent = osutils.dirname(path)
+    if parent == path:
+      break
+    path = parent
+
+  return os.stat(path).st_dev
+
+# The End.
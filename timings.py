@@ -0,0 +1,162 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Lightweight per-phase timing instrumentation
+
+When enabled, the plugin records the wall-clock time spent in each phase
+of a comparison (revision resolution, changes_from, extraction, the tool
+itself, cleanup), along with counters for the files and bytes written
+and the number of processes spawned.  A summary is printed on stderr
+when the command finishes.
+
+Timings are enabled by the '-Dtimings' debug flag, or by setting the
+BZR_DIFFTOOLS_TIMINGS environment variable.  If the variable is set to
+anything other than '1' or 'stderr' (or one of the OFF_VALUES, such as
+'0', which leave the timings disabled), it is taken as the name of a
+file, and the results are appended to it as one JSON object per line.
+
+Instrumented code uses start() and stop() around each phase (in a
+try/finally, so a failed phase is still timed), or timed() to time a
+single call, and count() for the counters; when timings are disabled,
+these return immediately.
+"""
+
+import os
+import sys
+import threading
+import time
+
+
+# Values of BZR_DIFFTOOLS_TIMINGS that leave the timings disabled:
+OFF_VALUES = ('', '0', 'false', 'no', 'off')
+
+# Set by configure(), and checked first by every other function:
+enabled = False
+destination = None
+
+_phases = []
+_times = {}
+_counters = []
+_counts = {}
+_lock = threading.Lock()
+
+
+def configure():
+  """
+  Enable the timings if they were requested, and reset any old results.
+  """
+  global enabled, destination
+  destination = os.environ.get('BZR_DIFFTOOLS_TIMINGS')
+  if destination is not None and destination.strip().lower() in OFF_VALUES:
+    destination = None
+  if destination is None:
+    try:
+      from bzrlib import debug
+      if 'timings' in debug.debug_flags:
+        destination = 'stderr'
+    except ImportError:
+      pass
+  enabled = (destination is not None)
+
+  del _phases[:]
+  _times.clear()
+  del _counters[:]
+  _counts.clear()
+  return
+
+
+def start(name):
+  """
+  Start timing a phase, return a token to pass to stop().
+  """
+  if not enabled:
+    return None
+  return (name, time.time())
+
+
+def stop(token, **counters):
+  """
+  Stop timing a phase, and add to any counters given as keywords.
+  """
+  if token is None:
+    return
+  (name, start_time) = token
+  elapsed = time.time() - start_time
+  _lock.acquire()
+  try:
+    if name not in _times:
+      _phases.append(name)
+      _times[name] = [0.0, 0]
+    _times[name][0] += elapsed
+    _times[name][1] += 1
+  finally:
+    _lock.release()
+  for (counter, amount) in counters.items():
+    count(counter, amount)
+  return
+
+
+def timed(name, func, *args, **kwargs):
+  """
+  Call func(*args, **kwargs), timing the call as a phase even if it fails.
+  """
+  timer = start(name)
+  try:
+    return func(*args, **kwargs)
+  finally:
+    stop(timer)
+
+
+def count(counter, amount=1):
+  """
+  Add to a counter (e.g. 'bytes_written', 'spawns').
+  """
+  if not enabled:
+    return
+  _lock.acquire()
+  try:
+    if counter not in _counts:
+      _counters.append(counter)
+      _counts[counter] = 0
+    _counts[counter] += amount
+  finally:
+    _lock.release()
+  return
+
+
+def report():
+  """
+  Write the summary to stderr, or append it to the log file.
+  """
+  if not enabled:
+    return
+  if destination in ('1', 'stderr'):
+    sys.stderr.write('difftools timings:\n')
+    for name in _phases:
+      (seconds, calls) = _times[name]
+      sys.stderr.write('  %-24s %9.3fs  (%d calls)\n' % (name, seconds, calls))
+    for counter in _counters:
+      sys.stderr.write('  %-24s %10d\n' % (counter, _counts[counter]))
+  else:
+    try:
+      import json
+    except ImportError:
+      import simplejson as json
+    record = {
+        'time': time.time(),
+        'argv': sys.argv,
+        'phases': dict([(name, {'seconds': _times[name][0],
+                                'calls': _times[name][1]})
+                        for name in _phases]),
+        'counters': _counts,
+        }
+    log = open(destination, 'a')
+    try:
+      log.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+      log.close()
+  return
+
+# The End.
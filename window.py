@@ -0,0 +1,222 @@
+# Copyright (C) 2006  Stephen Ward
+
+# GNU GPL v2.
+
+"""
+Windowed copies of very large files
+
+When a changed file is hundreds of megabytes (a log, a database dump, some
+generated code), a GUI diff tool takes a long time, and a lot of memory,
+just to load both copies, even if only a few lines differ.  Instead, the
+two files can be replaced by copies that hold only the changed regions,
+with some context, so the tool's load time depends on the size of the
+change, not the size of the file.
+
+Both files are mapped into memory (mmap), and split into lines, which are
+grouped into content-defined blocks: a block ends after any line whose
+hash has its low bits clear, so inserting or removing lines only changes
+the blocks around the edit.  The sequences of block hashes are matched
+with the patience diff algorithm, and each run of unmatched blocks (plus
+CONTEXT_LINES on either side) becomes a window.  Each window is written
+to both copies after a marker line, giving its line numbers in the
+original file, so the tool shows the windows side by side.
+
+Windowing is enabled by setting 'difftools_window_size' in bazaar.conf,
+to the size (in bytes) from which a file is windowed; it only applies
+when a single file is compared.
+"""
+
+import mmap
+import os
+from array import array
+from cStringIO import StringIO
+
+from bzrlib import (
+    config,
+    errors,
+    osutils,
+    patiencediff,
+    )
+
+
+# Number of unchanged lines kept around each changed region:
+CONTEXT_LINES = 20
+
+# A block ends after a line whose hash has none of these bits set, so the
+# blocks hold about 64 lines on average:
+BLOCK_MASK = 0x3f
+
+# The line written at the start of each window:
+WINDOW_MARKER = '=== bzr difftools: lines %d-%d of %d ===\n'
+
+
+class LineIndex(object):
+  """
+  The hash and starting offset of each line in a text.
+  """
+
+  def __init__(self, text):
+    """
+    Index the lines of a text (a string, or a memory-mapped file).
+    """
+    self.text = text
+    self.offsets = array('L', [0])
+    self.hashes = array('l')
+    if isinstance(text, basestring):
+      readline = StringIO(text).readline
+    else:
+      text.seek(0)
+      readline = text.readline
+    offset = 0
+    line = readline()
+    while line:
+      offset += len(line)
+      self.offsets.append(offset)
+      self.hashes.append(hash(line))
+      line = readline()
+    return
+
+  def __len__(self):
+    return len(self.hashes)
+
+  def lines(self, start, end):
+    """
+    Return the text of lines start to end (counting from 0, excluding end).
+    """
+    return self.text[self.offsets[start]:self.offsets[end]]
+
+  def blocks(self):
+    """
+    Group the lines into content-defined blocks.
+
+    Return a list of block hashes, and a list of the first line of each
+    block (with one more entry, for the end of the last block).
+    """
+    block_hashes = []
+    starts = [0]
+    block = []
+    for (i, line_hash) in enumerate(self.hashes):
+      block.append(line_hash)
+      if not (line_hash & BLOCK_MASK):
+        block_hashes.append(hash(tuple(block)))
+        starts.append(i + 1)
+        block = []
+    if block:
+      block_hashes.append(hash(tuple(block)))
+      starts.append(len(self.hashes))
+
+    return (block_hashes, starts)
+
+  # End class LineIndex
+
+
+# Functions:
+
+def get_window_size():
+  """
+  Return the size from which files are windowed, or 0 if it is disabled.
+  """
+  size = config.GlobalConfig().get_user_option('difftools_window_size')
+  try:
+    return int(size or 0)
+  except ValueError:
+    raise errors.BzrError(
+        "Invalid value for difftools_window_size: %r" % size)
+
+
+def needs_window(old_path, new_path, min_size):
+  """
+  Check if a pair of regular files is big enough to be windowed.
+  """
+  if not (os.path.isfile(old_path) and os.path.isfile(new_path)):
+    return False
+  return max(os.path.getsize(old_path), os.path.getsize(new_path)) >= min_size
+
+
+def write_windows(old_path, new_path, old_copy, new_copy,
+                  context=CONTEXT_LINES):
+  """
+  Write read-only copies of two files, with only their changed regions.
+
+  Return the number of windows written.
+  """
+  old_text = map_file(old_path)
+  new_text = map_file(new_path)
+  try:
+    old_index = LineIndex(old_text)
+    new_index = LineIndex(new_text)
+    windows = changed_windows(old_index, new_index, context)
+    write_copy(old_index, [(a1, a2) for (a1, a2, b1, b2) in windows],
+               old_copy)
+    write_copy(new_index, [(b1, b2) for (a1, a2, b1, b2) in windows],
+               new_copy)
+  finally:
+    for text in (old_text, new_text):
+      if not isinstance(text, basestring):
+        text.close()
+
+  return len(windows)
+
+
+def changed_windows(old_index, new_index, context=CONTEXT_LINES):
+  """
+  Return (old_start, old_end, new_start, new_end) line ranges that differ.
+
+  Each range includes up to 'context' lines on either side, and ranges
+  that overlap (on either side) are merged.
+  """
+  (old_blocks, old_starts) = old_index.blocks()
+  (new_blocks, new_starts) = new_index.blocks()
+  matcher = patiencediff.PatienceSequenceMatcher(None, old_blocks,
+                                                 new_blocks)
+  windows = []
+  for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+    if tag == 'equal':
+      continue
+    window = (max(old_starts[i1] - context, 0),
+              min(old_starts[i2] + context, len(old_index)),
+              max(new_starts[j1] - context, 0),
+              min(new_starts[j2] + context, len(new_index)))
+    if windows and (window[0] <= windows[-1][1] or
+                    window[2] <= windows[-1][3]):
+      last = windows[-1]
+      window = (last[0], max(last[1], window[1]),
+                last[2], max(last[3], window[3]))
+      windows[-1] = window
+    else:
+      windows.append(window)
+
+  return windows
+
+
+def write_copy(index, ranges, dest_path):
+  """
+  Write the given (start, end) line ranges of a text, each after a marker.
+  """
+  # write in binary mode, to avoid OS-specific translations:
+  f = open(dest_path, 'wb')
+  try:
+    for (start, end) in ranges:
+      f.write(WINDOW_MARKER % (start + 1, end, len(index)))
+      f.write(index.lines(start, end))
+  finally:
+    f.close()
+  osutils.make_readonly(dest_path)
+  return
+
+
+def map_file(path):
+  """
+  Map a file into memory, read-only (an empty file is just '').
+  """
+  f = open(path, 'rb')
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return ''
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+  finally:
+    # The mapping stays valid after the file is closed:
+    f.close()
+
+# The End.